@@ -3,23 +3,47 @@ import dateutil
 import dateutil.parser
 import os
 
+# The reference tables, next to this script whatever the working directory
+DIVIDEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dividend')
+
 exempt_detail_columns = ['Symbol (Brokerage)', 'Date', 'Ordinary Dividends', 'Interest Percentage', 'Interest-Related Dividend']
 exempt_detail = pd.DataFrame(columns=exempt_detail_columns)
 
-vanguard_cusip_to_symbol = {}
-vanguard_interest = {}  # Vanguard percentage = interest / dividend for each month
-vanguard_dividend = {}
-fidelity_cusip_to_symbol = {}
-fidelity_percentage = {}  # Fidelity percentage is for each year
-others_cusip_to_symbol = {}
-others_percentage = {}  # Percentage for each month
+
+class ExemptInfo:
+    # Reference tables filled by the read_*_exempt_info() functions.
+    # They are not modified after loading, except that the Vanguard dividends of each symbol are read on first use
+    # (see read_vanguard_dividend()), so one instance can be shared by concurrent computations.
+    # holdings: the CUSIPs and symbols to keep from the reference tables (see scan_holdings()), or None for all
+
+    def __init__(self, holdings=None):
+        self.holdings = holdings
+        self.vanguard_cusip_to_symbol = {}
+        self.vanguard_interest = {}  # Vanguard percentage = interest / dividend for each month
+        self.vanguard_dividend = {}  # filled for each symbol on first use
+        self.fidelity_cusip_to_symbol = {}
+        self.fidelity_percentage = {}  # Fidelity percentage is for each year
+        self.others_cusip_to_symbol = {}
+        self.others_percentage = {}  # Percentage for each month
+
+    def holds(self, symbol, cusip=None):
+        return self.holdings is None or symbol in self.holdings or cusip in self.holdings
 
 
-def append_row(df, row):
-    return pd.concat([
-        df,
-        pd.DataFrame([row], columns=row.index)]
-    ).reset_index(drop=True)
+exempt_info = ExemptInfo()  # used when no ExemptInfo is given
+vanguard_cusip_to_symbol = exempt_info.vanguard_cusip_to_symbol
+vanguard_interest = exempt_info.vanguard_interest
+vanguard_dividend = exempt_info.vanguard_dividend
+fidelity_cusip_to_symbol = exempt_info.fidelity_cusip_to_symbol
+fidelity_percentage = exempt_info.fidelity_percentage
+others_cusip_to_symbol = exempt_info.others_cusip_to_symbol
+others_percentage = exempt_info.others_percentage
+
+
+def append_rows(df, rows):
+    if len(df) == 0:
+        return rows.reset_index(drop=True)
+    return pd.concat([df, rows]).reset_index(drop=True)
 
 
 def remove_equal_sign(s):
@@ -61,12 +85,15 @@ def percentage_to_float(x):
     return float(x.strip('%')) / 100
 
 
-def read_vanguard_dividend(symbol):
-    global vanguard_dividend
-    path = f'dividend/vanguard/{symbol}.csv'
+def read_vanguard_dividend(symbol, info=None):
+    # Returns whether the dividends of the symbol are available, reading them only the first time
+    info = exempt_info if info is None else info
+    if symbol in info.vanguard_dividend.keys():
+        return True
+    path = os.path.join(DIVIDEND_DIR, 'vanguard', f'{symbol}.csv')
     if not os.path.isfile(path):
         return False
-    vanguard_dividend[symbol] = {}
+    dividend = {}
     with open(path, 'r') as fn:
         lines = fn.readlines()
         for line in lines:
@@ -74,57 +101,59 @@ def read_vanguard_dividend(symbol):
             if line[0] == 'Dividend':
                 date = dateutil.parser.parse(line[2])
                 amount = read_money_value(line[1])
-                vanguard_dividend[symbol][date] = amount
+                dividend[date] = amount
+    # Only complete tables are visible to other threads
+    info.vanguard_dividend[symbol] = dividend
     return True
 
 
-def read_vanguard_exempt_info(tax_year=2023):
-    global vanguard_cusip_to_symbol
-    global vanguard_interest
-    filename = f'dividend/{tax_year}/{tax_year}_VGI_NRA Layout.csv'
+def read_vanguard_exempt_info(tax_year=2023, info=None):
+    info = exempt_info if info is None else info
+    filename = os.path.join(DIVIDEND_DIR, str(tax_year), f'{tax_year}_VGI_NRA Layout.csv')
     with open(filename, 'r') as fn:
         lines = fn.readlines()
         for line in lines:
             line = line.strip().split(',')
             if len(line) >= 7 and all_capital_letters(line[2].strip()):
                 symbol = line[2].strip()
+                if not info.holds(symbol, line[1].strip()):
+                    continue
                 amount = read_money_value(line[6])
                 if amount == 0:
                     continue
                 if line[0].strip() == 'TOTALS':
                     continue
-                if symbol not in vanguard_interest.keys():
+                if symbol not in info.vanguard_interest.keys():
                     cusip = line[1].strip()
-                    vanguard_cusip_to_symbol[cusip] = symbol
-                    vanguard_interest[symbol] = {}
-                if symbol not in vanguard_dividend.keys():
-                    read_vanguard_dividend(symbol)
+                    info.vanguard_cusip_to_symbol[cusip] = symbol
+                    info.vanguard_interest[symbol] = {}
                 date = dateutil.parser.parse(line[5])
-                vanguard_interest[symbol][date] = amount
+                info.vanguard_interest[symbol][date] = amount
 
 
-def read_fidelity_exempt_info(tax_year=2023):
-    global fidelity_cusip_to_symbol
-    global fidelity_percentage
-    filename = f'dividend/{tax_year}/fidelity{tax_year}.txt'
+def read_fidelity_exempt_info(tax_year=2023, info=None):
+    info = exempt_info if info is None else info
+    filename = os.path.join(DIVIDEND_DIR, str(tax_year), f'fidelity{tax_year}.txt')
     with open(filename, 'r') as fn:
         lines = fn.readlines()
         for line in lines:
             line = line.strip().split()
             assert 2 <= len(line) <= 3
-            fidelity_percentage[line[0]] = percentage_to_float(line[1])
+            if not info.holds(line[0], line[2] if len(line) == 3 else None):
+                continue
+            info.fidelity_percentage[line[0]] = percentage_to_float(line[1])
             if len(line) == 3:
-                fidelity_cusip_to_symbol[line[2]] = line[0]
+                info.fidelity_cusip_to_symbol[line[2]] = line[0]
 
 
-def read_jpmorgan_exempt_info(tax_year=2024):
-    global others_cusip_to_symbol
-    global others_percentage
-    filename = f'dividend/{tax_year}/jpmorgan{tax_year}.txt'
+def read_jpmorgan_exempt_info(tax_year=2024, info=None):
+    info = exempt_info if info is None else info
+    filename = os.path.join(DIVIDEND_DIR, str(tax_year), f'jpmorgan{tax_year}.txt')
     dates = []
     phase = 0
     symbol = ''
     counter = 0
+    held = False
     with open(filename, 'r', encoding='UTF-8') as fn:
         lines = fn.readlines()
         for line in lines:
@@ -144,13 +173,16 @@ def read_jpmorgan_exempt_info(tax_year=2024):
             if phase == 2:
                 # symbol
                 symbol = line
-                others_percentage[symbol] = {}
                 phase = 3
                 continue
             if phase == 3:
                 # cusip
                 cusip = line
-                others_cusip_to_symbol[cusip] = symbol
+                # The other funds are still walked through to keep track of the layout, but not stored
+                held = info.holds(symbol, cusip)
+                if held:
+                    info.others_percentage[symbol] = {}
+                    info.others_cusip_to_symbol[cusip] = symbol
                 phase = 4
                 counter = 0
                 continue
@@ -161,10 +193,12 @@ def read_jpmorgan_exempt_info(tax_year=2024):
                         p = percentage_to_float(line)
                     except ValueError as e:
                         # less than 12 months
-                        print(f'{symbol} does not have {len(dates)} values. Please double check if some numbers are missing.')
+                        if held:
+                            print(f'{symbol} does not have {len(dates)} values. Please double check if some numbers are missing.')
                         phase = 2
                         continue
-                    others_percentage[symbol][dates[counter]] = p
+                    if held:
+                        info.others_percentage[symbol][dates[counter]] = p
                 counter += 1
                 if counter >= len(dates):
                     phase = 5
@@ -175,14 +209,15 @@ def read_jpmorgan_exempt_info(tax_year=2024):
                 continue
 
 
-def read_ishares_exempt_info(tax_year=2023):
-    global others_cusip_to_symbol
-    global others_percentage
-    filename = f'dividend/{tax_year}/ishares-qualified-interest-income-qii-percentages-final-{tax_year}.txt'
+def read_ishares_exempt_info(tax_year=2023, info=None):
+    info = exempt_info if info is None else info
+    filename = os.path.join(DIVIDEND_DIR, str(tax_year),
+                            f'ishares-qualified-interest-income-qii-percentages-final-{tax_year}.txt')
     dates = []
     phase = 0
     symbol = ''
     counter = 0
+    held = False
     with open(filename, 'r', encoding='UTF-8') as fn:
         lines = fn.readlines()
         for line in lines:
@@ -202,13 +237,16 @@ def read_ishares_exempt_info(tax_year=2023):
             if phase == 2:
                 # symbol
                 symbol = line
-                others_percentage[symbol] = {}
                 phase = 3
                 continue
             if phase == 3:
                 # cusip
                 cusip = line
-                others_cusip_to_symbol[cusip] = symbol
+                # The other funds are still walked through to keep track of the layout, but not stored
+                held = info.holds(symbol, cusip)
+                if held:
+                    info.others_percentage[symbol] = {}
+                    info.others_cusip_to_symbol[cusip] = symbol
                 phase = 4
                 counter = 0
                 continue
@@ -219,10 +257,12 @@ def read_ishares_exempt_info(tax_year=2023):
                         p = percentage_to_float(line)
                     except ValueError as e:
                         # less than 12 months
-                        print(f'{symbol} does not have {len(dates)} values. Please double check if some numbers are missing.')
+                        if held:
+                            print(f'{symbol} does not have {len(dates)} values. Please double check if some numbers are missing.')
                         phase = 2
                         continue
-                    others_percentage[symbol][dates[counter]] = p
+                    if held:
+                        info.others_percentage[symbol][dates[counter]] = p
                 counter += 1
                 if counter >= len(dates):
                     phase = 5
@@ -233,8 +273,10 @@ def read_ishares_exempt_info(tax_year=2023):
                 continue
 
 
-def compute_morgan_stanley_dividend(filename):
-    global exempt_detail
+def morgan_stanley_exempt_detail(filename, info=None):
+    # Returns the rows of exempt_detail for the statement
+    info = exempt_info if info is None else info
+    rows = []
     total_dividend = None
     phase = -1
     symbol = None
@@ -253,18 +295,18 @@ def compute_morgan_stanley_dividend(filename):
                 phase = 0
                 continue
             if phase == 0:
-                if line in vanguard_cusip_to_symbol.keys():
-                    symbol = vanguard_cusip_to_symbol[line]
+                if line in info.vanguard_cusip_to_symbol.keys():
+                    symbol = info.vanguard_cusip_to_symbol[line]
                     is_vanguard = True
                     is_fidelity = False
                     phase = 1
-                if line in fidelity_cusip_to_symbol.keys():
-                    symbol = fidelity_cusip_to_symbol[line]
+                if line in info.fidelity_cusip_to_symbol.keys():
+                    symbol = info.fidelity_cusip_to_symbol[line]
                     is_vanguard = False
                     is_fidelity = True
                     phase = 1
-                if line in others_cusip_to_symbol.keys():
-                    symbol = others_cusip_to_symbol[line]
+                if line in info.others_cusip_to_symbol.keys():
+                    symbol = info.others_cusip_to_symbol[line]
                     is_vanguard = False
                     is_fidelity = False
                     phase = 1
@@ -280,37 +322,45 @@ def compute_morgan_stanley_dividend(filename):
                     continue
                 exempt_percentage = 0
                 if is_vanguard:
-                    if symbol not in vanguard_dividend.keys():
+                    if not read_vanguard_dividend(symbol, info):
                         print(
                             f'Missing dividend info for {symbol}. Please go to https://investor.vanguard.com/investment-products/etfs/profile/{symbol.lower()} to get the dividend information.')
                         continue
-                    if date not in vanguard_dividend[symbol].keys():
+                    if date not in info.vanguard_dividend[symbol].keys():
                         print(f'Missing dividend info for {symbol} on {date.strftime("%m/%d/%Y")}.')
                         continue
-                    if date not in vanguard_interest[symbol].keys():
+                    if date not in info.vanguard_interest[symbol].keys():
                         print(f'Missing interest info for {symbol} on {date.strftime("%m/%d/%Y")}.')
                         continue
-                    exempt_percentage = vanguard_interest[symbol][date] / vanguard_dividend[symbol][date]
+                    exempt_percentage = info.vanguard_interest[symbol][date] / info.vanguard_dividend[symbol][date]
                 elif is_fidelity:
-                    exempt_percentage = fidelity_percentage[symbol]
+                    exempt_percentage = info.fidelity_percentage[symbol]
                 else:
-                    if date not in others_percentage[symbol].keys():
+                    if date not in info.others_percentage[symbol].keys():
                         print(f'Missing percentage info for {symbol} on {date.strftime("%m/%d/%Y")}.')
                         continue
-                    exempt_percentage = others_percentage[symbol][date]
+                    exempt_percentage = info.others_percentage[symbol][date]
                 total_exempt_amount += amount * exempt_percentage
                 new_item = pd.Series(
                     {'Symbol (Brokerage)': f"{symbol} (Morgan Stanley)", 'Date': date.strftime("%m/%d/%Y"), 'Ordinary Dividends': amount,
                      'Interest Percentage': f"{exempt_percentage:.2%}", 'Interest-Related Dividend': amount * exempt_percentage})
-                exempt_detail = append_row(exempt_detail, new_item)
+                rows.append(new_item)
                 appeared_symbols.add(symbol)
                 continue
     print(f'Tax-exempt amount for Morgan Stanley: {total_exempt_amount}{f" ({total_exempt_amount / total_dividend * 100:.2f}%, {appeared_symbols})" if len(appeared_symbols) > 0 else ""}.')
     print(f'Remaining dividend for Morgan Stanley: {total_dividend - total_exempt_amount}.')
+    return pd.DataFrame(rows, columns=exempt_detail_columns)
 
 
-def compute_schwab_dividend(filename):
+def compute_morgan_stanley_dividend(filename, info=None):
     global exempt_detail
+    exempt_detail = append_rows(exempt_detail, morgan_stanley_exempt_detail(filename, info))
+
+
+def schwab_exempt_detail(filename, info=None):
+    # Returns the rows of exempt_detail for the statement
+    info = exempt_info if info is None else info
+    rows = []
     total_dividend = None
     phase = -1
     symbol = None
@@ -330,18 +380,18 @@ def compute_schwab_dividend(filename):
                 phase = 0
                 continue
             if phase == 0:
-                if line in vanguard_cusip_to_symbol.keys():
-                    symbol = vanguard_cusip_to_symbol[line]
+                if line in info.vanguard_cusip_to_symbol.keys():
+                    symbol = info.vanguard_cusip_to_symbol[line]
                     is_vanguard = True
                     is_fidelity = False
                     phase = 1
-                if line in fidelity_cusip_to_symbol.keys():
-                    symbol = fidelity_cusip_to_symbol[line]
+                if line in info.fidelity_cusip_to_symbol.keys():
+                    symbol = info.fidelity_cusip_to_symbol[line]
                     is_vanguard = False
                     is_fidelity = True
                     phase = 1
-                if line in others_cusip_to_symbol.keys():
-                    symbol = others_cusip_to_symbol[line]
+                if line in info.others_cusip_to_symbol.keys():
+                    symbol = info.others_cusip_to_symbol[line]
                     is_vanguard = False
                     is_fidelity = False
                     phase = 1
@@ -367,29 +417,29 @@ def compute_schwab_dividend(filename):
                 min_this_time = 1
                 max_this_time = 0
                 if is_vanguard:
-                    if symbol not in vanguard_dividend.keys():
+                    if not read_vanguard_dividend(symbol, info):
                         print(
                             f'Missing dividend info for {symbol}. Please go to https://investor.vanguard.com/investment-products/etfs/profile/{symbol.lower()} to get the dividend information.')
                         continue
                     total_int = 0.0
                     total_div = 0.0
-                    for date in vanguard_dividend[symbol].keys():
-                        if date not in vanguard_interest[symbol].keys():
+                    for date in info.vanguard_dividend[symbol].keys():
+                        if date not in info.vanguard_interest[symbol].keys():
                             print(f'Missing interest info for {symbol} on {date.strftime("%m/%d/%Y")}.')
                             continue
-                        total_int += vanguard_interest[symbol][date]
-                        total_div += vanguard_dividend[symbol][date]
+                        total_int += info.vanguard_interest[symbol][date]
+                        total_div += info.vanguard_dividend[symbol][date]
                         min_this_time = min(min_this_time, total_int / total_div)
                         max_this_time = max(max_this_time, total_int / total_div)
                     exempt_percentage = total_int / total_div
                 elif is_fidelity:
-                    min_this_time = fidelity_percentage[symbol]
-                    max_this_time = fidelity_percentage[symbol]
-                    exempt_percentage = fidelity_percentage[symbol]
+                    min_this_time = info.fidelity_percentage[symbol]
+                    max_this_time = info.fidelity_percentage[symbol]
+                    exempt_percentage = info.fidelity_percentage[symbol]
                 else:
-                    min_this_time = min(others_percentage[symbol].values())
-                    max_this_time = max(others_percentage[symbol].values())
-                    exempt_percentage = sum(others_percentage[symbol].values()) / len(others_percentage[symbol])
+                    min_this_time = min(info.others_percentage[symbol].values())
+                    max_this_time = max(info.others_percentage[symbol].values())
+                    exempt_percentage = sum(info.others_percentage[symbol].values()) / len(info.others_percentage[symbol])
                 total_exempt_amount += amount * exempt_percentage
                 min_total_exempt_amount += amount * min_this_time
                 max_total_exempt_amount += amount * max_this_time
@@ -397,7 +447,7 @@ def compute_schwab_dividend(filename):
                     {'Symbol (Brokerage)': f"{symbol} (Schwab{' Qualified Dividend' if symbol in appeared_symbols else ''})", 'Date': 'Various',
                      'Ordinary Dividends': amount,
                      'Interest Percentage': f"{exempt_percentage:.2%}", 'Interest-Related Dividend': amount * exempt_percentage})
-                exempt_detail = append_row(exempt_detail, new_item)
+                rows.append(new_item)
                 appeared_symbols.add(symbol)
                 continue
     print(f'Tax-exempt amount for Schwab: {total_exempt_amount}{f" ({total_exempt_amount / total_dividend * 100:.2f}%, {appeared_symbols})" if len(appeared_symbols) > 0 else ""}.')
@@ -405,10 +455,18 @@ def compute_schwab_dividend(filename):
     if min_total_exempt_amount != max_total_exempt_amount:
         print(
             f'Because Schwab only reports the total dividend amount, the tax-exempt amount can be in [{min_total_exempt_amount}, {max_total_exempt_amount}]. The average amount is reported here.')
+    return pd.DataFrame(rows, columns=exempt_detail_columns)
 
 
-def compute_fidelity_dividend(filename):
+def compute_schwab_dividend(filename, info=None):
     global exempt_detail
+    exempt_detail = append_rows(exempt_detail, schwab_exempt_detail(filename, info))
+
+
+def fidelity_exempt_detail(filename, info=None):
+    # Returns the rows of exempt_detail for the statement
+    info = exempt_info if info is None else info
+    rows = []
     total_dividend = None
     phase = -1
     symbol = None
@@ -433,17 +491,17 @@ def compute_fidelity_dividend(filename):
                 if len(line) != 3:
                     continue
                 line = line[1].strip()  # symbol
-                if line in vanguard_interest.keys():
+                if line in info.vanguard_interest.keys():
                     symbol = line
                     is_vanguard = True
                     is_fidelity = False
                     phase = 1
-                if line in fidelity_percentage.keys():
+                if line in info.fidelity_percentage.keys():
                     symbol = line
                     is_vanguard = False
                     is_fidelity = True
                     phase = 1
-                if line in others_percentage.keys():
+                if line in info.others_percentage.keys():
                     symbol = line
                     is_vanguard = False
                     is_fidelity = False
@@ -467,27 +525,27 @@ def compute_fidelity_dividend(filename):
                     phase = 1
                     continue
                 if is_vanguard:
-                    if symbol not in vanguard_dividend.keys():
+                    if not read_vanguard_dividend(symbol, info):
                         print(
                             f'Missing dividend info for {symbol}. Please go to https://investor.vanguard.com/investment-products/etfs/profile/{symbol.lower()} to get the dividend information.')
                         continue
-                    if date not in vanguard_dividend[symbol].keys():
+                    if date not in info.vanguard_dividend[symbol].keys():
                         print(f'Missing dividend info for {symbol} on {date.strftime("%m/%d/%Y")}.')
                         continue
-                    if date not in vanguard_interest[symbol].keys():
+                    if date not in info.vanguard_interest[symbol].keys():
                         print(f'Missing interest info for {symbol} on {date.strftime("%m/%d/%Y")}.')
                         continue
-                    exempt_percentage = vanguard_interest[symbol][date] / vanguard_dividend[symbol][date]
+                    exempt_percentage = info.vanguard_interest[symbol][date] / info.vanguard_dividend[symbol][date]
                 else:
-                    if date not in others_percentage[symbol].keys():
+                    if date not in info.others_percentage[symbol].keys():
                         print(f'Missing percentage info for {symbol} on {date.strftime("%m/%d/%Y")}.')
                         continue
-                    exempt_percentage = others_percentage[symbol][date]
+                    exempt_percentage = info.others_percentage[symbol][date]
                 total_exempt_amount += amount * exempt_percentage
                 new_item = pd.Series(
                     {'Symbol (Brokerage)': f"{symbol} (Fidelity)", 'Date': date.strftime("%m/%d/%Y"), 'Ordinary Dividends': amount,
                      'Interest Percentage': f"{exempt_percentage:.2%}", 'Interest-Related Dividend': amount * exempt_percentage})
-                exempt_detail = append_row(exempt_detail, new_item)
+                rows.append(new_item)
                 appeared_symbols.add(symbol)
                 phase = 1
                 continue
@@ -501,18 +559,53 @@ def compute_fidelity_dividend(filename):
                     phase = 0
                     continue
                 # Compute Fidelity fund here
-                exempt_percentage = fidelity_percentage[symbol]
+                exempt_percentage = info.fidelity_percentage[symbol]
                 total_exempt_amount += amount * exempt_percentage
                 new_item = pd.Series(
                     {'Symbol (Brokerage)': f"{symbol} (Fidelity)", 'Date': 'Various',
                      'Ordinary Dividends': amount,
                      'Interest Percentage': f"{exempt_percentage:.2%}", 'Interest-Related Dividend': amount * exempt_percentage})
-                exempt_detail = append_row(exempt_detail, new_item)
+                rows.append(new_item)
                 appeared_symbols.add(symbol)
                 phase = 0
                 continue
     print(f'Tax-exempt amount for Fidelity: {total_exempt_amount}{f" ({total_exempt_amount / total_dividend * 100:.2f}%, {appeared_symbols})" if len(appeared_symbols) > 0 else ""}.')
     print(f'Remaining dividend for Fidelity: {total_dividend - total_exempt_amount}.')
+    return pd.DataFrame(rows, columns=exempt_detail_columns)
+
+
+def compute_fidelity_dividend(filename, info=None):
+    global exempt_detail
+    exempt_detail = append_rows(exempt_detail, fidelity_exempt_detail(filename, info))
+
+
+def scan_holdings(filenames):
+    # The CUSIPs and symbols that may appear in the dividend details: every line and every comma-separated part
+    holdings = set()
+    for filename in filenames:
+        with open(filename, 'r') as fn:
+            for line in fn:
+                holdings.add(line.strip())
+                holdings.update(part.strip() for part in line.split(','))
+    return holdings
+
+
+def load_exempt_info(tax_year, holdings=None):
+    # A new ExemptInfo with every reference table available for the tax year,
+    # restricted to the holdings if given (see scan_holdings()).
+    # Raises FileNotFoundError if there is no reference table for the tax year at all.
+    info = ExemptInfo(holdings)
+    loaded = 0
+    for read_exempt_info in [read_vanguard_exempt_info, read_fidelity_exempt_info, read_ishares_exempt_info,
+                             read_jpmorgan_exempt_info]:
+        try:
+            read_exempt_info(tax_year, info)
+            loaded += 1
+        except FileNotFoundError as e:
+            print(f'Skipping {e.filename}: not found.')
+    if loaded == 0:
+        raise FileNotFoundError(f'No reference table for {tax_year} in {os.path.join(DIVIDEND_DIR, str(tax_year))}')
+    return info
 
 
 def show_exempt_detail(filename='exempt_detail.csv'):
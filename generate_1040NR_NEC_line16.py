@@ -1,24 +1,163 @@
+import csv
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
 import pandas as pd
 import dateutil
 from collections import deque
+from bisect import bisect_right
+from heapq import heappush, heappop, merge
+from itertools import repeat
 
 activity_columns = ['Date', 'Description', 'Symbol', 'Action', 'Quantity', 'Price', 'Amount']
 activity = pd.DataFrame(columns=activity_columns)
 
 gain_loss_columns = ['(a) Kind of property and description', '(b) Date acquired', '(c) Date sold', '(d) Sales price',
                      '(e) Cost or other basis', '(f) LOSS', '(g) GAIN']
-gain_loss = pd.DataFrame(columns=gain_loss_columns)
+# Kept alongside the form columns but not written to line 16: dates are ordinals (datetime.date.toordinal()), 0 if unknown
+holding_period_columns = ['Brokerage', 'Acquired', 'Sold']
+gain_loss = pd.DataFrame(columns=gain_loss_columns + holding_period_columns)
 
 transfer_history_columns = ['Date', 'Symbol', 'Side', 'Quantity', 'Cost Basis', 'Price if sold']
+# Specific identification: the disposal (a Sell or a Sent transfer at Date) takes Quantity from the lot Lot ID
+lot_designation_columns = ['Date', 'Symbol', 'Side', 'Lot ID', 'Quantity']
+# Fields identifying a fill in the Robinhood crypto activity, used to drop fills repeated across files
+robinhood_crypto_key_columns = ['UUID', 'Time Entered', 'Symbol', 'Side', 'Quantity', 'State', 'Average Price', 'Notional']
 stable_coins = set(['USDC'])
+# Lot order for sales (and transfers treated as sold), and for other outbound transfers
+cost_basis_methods = {
+    'FIFO': ('FIFO', 'FIFO'),
+    'LIFO': ('LIFO', 'LIFO'),
+    'HIFO': ('HIFO', 'HIFO'),
+    'Tax harvest': ('HIFO', 'LOFO'),
+}
+# Cash App transaction types of the crypto events
+cash_app_sides = {
+    'Bitcoin Boost': 'Buy',
+    'Bitcoin Buy': 'Buy',
+    'Bitcoin Sale': 'Sell',
+    'Bitcoin Withdrawal': 'Sent',
+    'Bitcoin Deposit': 'Received',
+}
+# A transfer sent from one platform is linked to one received on another platform within these days,
+# with the received quantity short of the sent quantity by at most this fraction (network fee)
+TRANSFER_LINK_DAYS = 7
+TRANSFER_FEE_TOLERANCE = 0.01
+# Rows of the crypto engines: one per lot piece (None), per disposal, or per symbol, platform and day sold
+aggregate_modes = [None, 'disposal', 'day']
+audit_columns = ['Disposal', '(a) Kind of property and description', '(b) Date acquired', '(c) Date sold',
+                 '(d) Sales price', '(e) Cost or other basis', 'Brokerage']
+# Directory of the parsed inputs (see cached_parse()), None to always parse the text.
+# Bump PARSE_CACHE_VERSION when a parse_*() function changes what it returns.
+PARSE_CACHE_DIR = None
+PARSE_CACHE_VERSION = 2
+FIXED_POINT_NA = np.iinfo(np.int64).min
 EPS = 1e-10
+UNIX_EPOCH_ORDINAL = 719163  # datetime.date(1970, 1, 1).toordinal()
 
 
-def append_row(df, row):
-    return pd.concat([
-        df,
-        pd.DataFrame([row], columns=row.index)]
-    ).reset_index(drop=True)
+def append_rows(df, rows):
+    if len(df) == 0:
+        return rows.reset_index(drop=True)
+    return pd.concat([df, rows]).reset_index(drop=True)
+
+
+def file_hash(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as fn:
+        for block in iter(lambda: fn.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def fixed_point_decimals(values):
+    # The fewest decimals (up to 9) giving every value exactly as an integer number of 10**-decimals,
+    # None if there are none
+    if np.isinf(values).any():
+        return None
+    values = values[~np.isnan(values)]
+    for decimals in range(10):
+        scaled = np.round(values * 10 ** decimals)
+        if (np.abs(scaled) < 2 ** 53).all() and (scaled / 10 ** decimals == values).all():
+            return decimals
+    return None
+
+
+def save_parsed(table, path):
+    # One .npy file per column: datetimes as int64 nanoseconds, amounts in fixed point when exact,
+    # text as categorical codes with the categories in columns.json
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.{id(table)}.tmp'
+    os.makedirs(temp_path)
+    columns = []
+    for i, name in enumerate(table.columns):
+        values = table[name]
+        column = {'name': name}
+        if pd.api.types.is_datetime64_any_dtype(values):
+            column['kind'] = 'datetime'
+            data = values.to_numpy(dtype='datetime64[ns]').view(np.int64)
+        elif pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+            column['kind'] = 'number'
+            data = values.to_numpy()
+        elif pd.api.types.is_float_dtype(values):
+            data = values.to_numpy(dtype=float)
+            decimals = fixed_point_decimals(data)
+            if decimals is None:
+                column['kind'] = 'number'
+            else:
+                column['kind'] = 'fixed'
+                column['decimals'] = decimals
+                data = np.where(np.isnan(data), FIXED_POINT_NA,
+                                np.round(np.nan_to_num(data) * 10 ** decimals)).astype(np.int64)
+        else:
+            categorical = pd.Categorical(values)
+            assert all(isinstance(category, str) for category in categorical.categories)
+            column['kind'] = 'text'
+            column['categories'] = list(categorical.categories)
+            data = np.asarray(categorical.codes, dtype=np.int32)
+        np.save(os.path.join(temp_path, f'{i}.npy'), data)
+        columns.append(column)
+    with open(os.path.join(temp_path, 'columns.json'), 'w') as fn:
+        json.dump({'rows': len(table), 'columns': columns}, fn)
+    try:
+        os.rename(temp_path, path)
+    except OSError:  # saved meanwhile by another thread or process
+        shutil.rmtree(temp_path)
+
+
+def load_parsed(path):
+    with open(os.path.join(path, 'columns.json')) as fn:
+        metadata = json.load(fn)
+    columns = {}
+    for i, column in enumerate(metadata['columns']):
+        data = np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r')
+        if column['kind'] == 'datetime':
+            data = data.view('datetime64[ns]')
+        elif column['kind'] == 'fixed':
+            data = np.where(data == FIXED_POINT_NA, np.nan, data / 10 ** column['decimals'])
+        elif column['kind'] == 'text':
+            codes = np.asarray(data)
+            data = np.full(len(codes), np.nan, dtype=object)
+            data[codes >= 0] = np.array(column['categories'], dtype=object)[codes[codes >= 0]]
+        columns[column['name']] = data
+    return pd.DataFrame(columns, index=pd.RangeIndex(metadata['rows']), copy=False)
+
+
+def cached_parse(parse, filename):
+    # parse(filename) turns the text of a file into a table of typed columns.
+    # With PARSE_CACHE_DIR, the table is saved once per file content and read back memory-mapped on later runs.
+    if PARSE_CACHE_DIR is None:
+        return parse(filename)
+    path = os.path.join(PARSE_CACHE_DIR, f'{parse.__name__}-{PARSE_CACHE_VERSION}-{file_hash(filename)}')
+    if os.path.isdir(path):
+        return load_parsed(path)
+    table = parse(filename)
+    save_parsed(table, path)
+    return table
 
 
 def remove_equal_sign(s):
@@ -47,67 +186,245 @@ def read_money_value(s):
         raise Exception(f"Unknown money value type: {s}")
 
 
-def read_and_compute_cash_app_btc(filename='cash_app_report_btc.csv', tax_year=None):
-    global gain_loss
-    cash_app_btc = pd.read_csv(filename)
-    cash_app_btc.rename({
-        'Notes': 'Description',
-        'Asset Type': 'Symbol',
-        'Transaction Type': 'Action',
-        'Asset Amount': 'Quantity',
-        'Asset Price': 'Price',
-        'Amount': 'Amount without fee',
-        'Net Amount': 'Amount'
-    }, axis=1, inplace=True)
-    cash_app_btc.sort_values('Date', inplace=True)
-    # activity = pd.concat([activity, cash_app_btc], join='inner')
-    asset = deque()
-    total_proceeds = 0
-    total_gain_loss = 0
+def parse_date_or_none(s):
+    try:
+        return dateutil.parser.parse(s)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def parse_dates(values):
+    # Parse a whole column of dates like "12/01/2023, 12:34:56" or "01/15/2023" at once.
+    # Anything in another format falls back to dateutil, and NaT if it is not a date (e.g., "Various").
+    values = pd.Series(values).astype(str).str.strip().reset_index(drop=True)
+    dates = pd.to_datetime(values, format='%m/%d/%Y, %H:%M:%S', errors='coerce')
+    missing = dates.isna()
+    if missing.any():
+        dates[missing] = pd.to_datetime(values[missing], format='%m/%d/%Y', errors='coerce')
+        missing = dates.isna()
+    if missing.any():
+        dates[missing] = pd.to_datetime(values[missing].map(parse_date_or_none))
+    return dates
+
+
+def to_ordinals(dates):
+    # datetime64 values (Series or array) to date ordinals, 0 for NaT
+    days = np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[D]')
+    return np.where(np.isnat(days), 0, days.astype(np.int64) + UNIX_EPOCH_ORDINAL)
+
+
+def date_ordinals(values):
+    return to_ordinals(parse_dates(values))
+
+
+def format_dates(ordinals):
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    days = np.where(ordinals == 0, np.datetime64('NaT'), (ordinals - UNIX_EPOCH_ORDINAL).astype('datetime64[D]'))
+    return pd.Series(days).dt.strftime("%m/%d/%Y").fillna('Various').to_numpy()
+
+
+def format_date(ordinal):
+    return datetime.date.fromordinal(int(ordinal)).strftime('%m/%d/%Y') if ordinal != 0 else 'Various'
+
+
+def ordinal_years(ordinals):
+    days = (np.asarray(ordinals, dtype=np.int64) - UNIX_EPOCH_ORDINAL).astype('datetime64[D]')
+    return days.astype('datetime64[Y]').astype(np.int64) + 1970
+
+
+def gain_loss_rows(descriptions, acquired, sold, sales_prices, costs, brokerage):
+    # acquired and sold are date ordinals
+    sales_prices = np.asarray(sales_prices, dtype=float)
+    costs = np.asarray(costs, dtype=float)
+    return pd.DataFrame({
+        '(a) Kind of property and description': descriptions,
+        '(b) Date acquired': format_dates(acquired),
+        '(c) Date sold': format_dates(sold), '(d) Sales price': sales_prices,
+        '(e) Cost or other basis': costs, '(f) LOSS': np.maximum(0.0, costs - sales_prices),
+        '(g) GAIN': np.maximum(0.0, sales_prices - costs),
+        'Brokerage': brokerage, 'Acquired': np.asarray(acquired, dtype=np.int64),
+        'Sold': np.asarray(sold, dtype=np.int64)}, columns=gain_loss_columns + holding_period_columns)
+
+
+class RealizedRows:
+    # Collects the lot pieces realized by the crypto engines into gain_loss rows as they come.
+    # aggregate (see aggregate_modes): sums the pieces of each disposal, or of each symbol and platform sold on the
+    # same day, into one row per holding term, with 'Various' as the date acquired if the pieces differ.
+    # The Acquired column then keeps the date of the first piece, which has the same holding term (see long_term()).
+    # audit: a .csv.gz file receiving every piece, to keep the detail of the aggregated rows
+
+    def __init__(self, aggregate=None, audit=None):
+        assert aggregate in aggregate_modes
+        self.aggregate = aggregate
+        # [quantity, symbol, platform, acquired, sold, sales price, cost, first disposal, various dates acquired]
+        self.rows = {}
+        self.audit_file = None
+        if audit is not None:
+            self.audit_file = gzip.open(audit, 'wt', newline='')
+            self.audit = csv.writer(self.audit_file)
+            self.audit.writerow(audit_columns)
+
+    def add(self, disposal, quantity, symbol, platform, acquired, sold, sales_price, cost, is_long_term=None):
+        # disposal: a number increasing with the time of the disposal, e.g., its position in the events
+        # is_long_term: the holding term of the piece if already known
+        if self.aggregate is not None and is_long_term is None:
+            is_long_term = bool(long_term([acquired], [sold])[0])
+        if self.aggregate == 'disposal':
+            key = (disposal, is_long_term)
+        elif self.aggregate == 'day':
+            key = (symbol, platform, sold, is_long_term)
+        else:
+            key = len(self.rows)
+        row = self.rows.get(key)
+        if row is None:
+            self.rows[key] = [quantity, symbol, platform, acquired, sold, sales_price, cost, disposal, False]
+        else:
+            row[0] += quantity
+            row[8] |= row[3] != acquired
+            row[5] += sales_price
+            row[6] += cost
+        if self.audit_file is not None:
+            self.audit.writerow([disposal, f'{quantity:.9f} {symbol} ({platform})', format_date(acquired),
+                                 format_date(sold), sales_price, cost, platform])
+
+    def add_many(self, disposals, quantities, symbol, platform, acquired, sold, sales_prices, costs):
+        is_long_term = long_term(acquired, sold) if self.aggregate is not None else repeat(None)
+        for row in zip(disposals, quantities, acquired, sold, sales_prices, costs, is_long_term):
+            self.add(row[0], row[1], symbol, platform, row[2], row[3], row[4], row[5], row[6])
+
+    def gain_loss_rows(self):
+        # Closes the audit file. The rows are in the order of their first disposal.
+        if self.audit_file is not None:
+            self.audit_file.close()
+            self.audit_file = None
+        rows = sorted(self.rows.values(), key=lambda row: row[7])
+        result = gain_loss_rows([f'{row[0]:.9f} {row[1]} ({row[2]})' for row in rows], [row[3] for row in rows],
+                                [row[4] for row in rows], [row[5] for row in rows], [row[6] for row in rows],
+                                [row[2] for row in rows])
+        result.loc[[row[8] for row in rows], '(b) Date acquired'] = 'Various'
+        return result
+
+
+def long_term(acquired, sold):
+    # One comparison for all rows: long-term if sold after the one-year anniversary of the acquisition,
+    # i.e. held for at least one year and a day. Property acquired on February 29 has its anniversary
+    # on February 28 of the next year.
+    acquired = (np.asarray(acquired, dtype=np.int64) - UNIX_EPOCH_ORDINAL).astype('datetime64[D]')
+    month = acquired.astype('datetime64[M]')
+    anniversary_month = (month + 12).astype('datetime64[D]')
+    days_in_anniversary_month = (month + 13).astype('datetime64[D]') - anniversary_month
+    anniversary = anniversary_month + np.minimum(acquired - month.astype('datetime64[D]'),
+                                                 days_in_anniversary_month - np.timedelta64(1, 'D'))
+    return np.asarray(sold, dtype=np.int64) - UNIX_EPOCH_ORDINAL > anniversary.astype(np.int64)
+
+
+def holding_periods(df):
+    acquired = df['Acquired'].to_numpy(dtype=np.int64)
+    sold = df['Sold'].to_numpy(dtype=np.int64)
+    known = (acquired > 0) & (sold > 0)
+    return pd.Series(np.where(known, np.where(long_term(np.where(known, acquired, sold), sold), 'Long-term', 'Short-term'),
+                              'Unknown'), index=df.index)
+
+
+def fifo_match(buy_quantities, sell_quantities):
+    # Split every sale across the lots it consumes under FIFO, without walking the lots one by one.
+    # Lot i covers (buy_end[i - 1], buy_end[i]] on the cumulative quantity axis and sale j covers
+    # (sell_end[j - 1], sell_end[j]], so the pieces are the intervals between the merged breakpoints.
+    # Returns the lot index, sale index and amount of each piece, in the order the FIFO loop produces them.
+    # The caller is responsible for checking that each lot is bought before the sale consuming it.
+    buy_quantities = np.asarray(buy_quantities, dtype=float)
+    sell_quantities = np.asarray(sell_quantities, dtype=float)
+    if len(sell_quantities) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    assert len(buy_quantities) > 0
+    # Cumulative sums of floats drift with the total volume, so the axis is in fixed point to keep the breakpoints exact
+    total = max(buy_quantities.sum(), sell_quantities.sum(), 1.0)
+    max_decimals = int(np.floor(np.log10(2.0 ** 62 / total)))
+    decimals = fixed_point_decimals(np.concatenate((buy_quantities, sell_quantities)))
+    decimals = max_decimals if decimals is None else min(decimals, max_decimals)
+    scale = 10 ** decimals
+    buy_units = np.round(buy_quantities * scale).astype(np.int64)
+    sell_units = np.round(sell_quantities * scale).astype(np.int64)
+    buy_end = np.cumsum(buy_units)
+    sell_end = np.cumsum(sell_units)
+    assert sell_end[-1] - buy_end[-1] <= EPS * scale
+    breakpoints = np.union1d(buy_end[buy_end < sell_end[-1]], sell_end)
+    start = np.concatenate(([0], breakpoints[:-1]))
+    units = breakpoints - start
+    keep = units > EPS * scale
+    start, end, units = start[keep], breakpoints[keep], units[keep]
+    lot = np.minimum(np.searchsorted(buy_end, start, side='right'), len(buy_end) - 1)
+    sale = np.searchsorted(sell_end, start, side='right')
+    # Pieces covering a whole lot or a whole sale take its quantity as is, like the loop does.
+    whole_lot = (start <= buy_end[lot] - buy_units[lot]) & (end >= buy_end[lot])
+    whole_sale = (start <= sell_end[sale] - sell_units[sale]) & (end >= sell_end[sale])
+    amount = np.where(whole_lot, buy_quantities[lot], np.where(whole_sale, sell_quantities[sale], units / scale))
+    return lot, sale, amount
+
+
+def parse_cash_app_report(filename):
+    # The columns of a Cash App report used by the readers, in the order of the file.
+    # Amount is the net amount without its sign.
+    cash_app = pd.read_csv(filename)
+    tzinfos = {"EST": dateutil.tz.gettz('America/Eastern'),
+               "EDT": dateutil.tz.gettz('America/Eastern')}
+    dates = cash_app['Date'].map(lambda x: dateutil.parser.parse(x, tzinfos=tzinfos).replace(tzinfo=None))
+    return pd.DataFrame({
+        'Date': pd.to_datetime(dates).to_numpy(),
+        'Symbol': cash_app['Asset Type'].to_numpy(),
+        'Transaction Type': cash_app['Transaction Type'].to_numpy(),
+        'Quantity': cash_app['Asset Amount'].astype(float).to_numpy(),
+        'Amount': cash_app['Net Amount'].str.replace(r'[-$(),\s]', '', regex=True).astype(float).to_numpy()})
+
+
+def cash_app_btc_gain_loss_rows(filename='cash_app_report_btc.csv', tax_year=None, designations=None, aggregate=None,
+                                audit=None):
+    # designations: a .csv file of lots designated for sales (lot_designation_columns), FIFO for the rest
+    # aggregate, audit: see RealizedRows
+    # Returns the rows of gain_loss for the file
+    if designations is not None:
+        assert tax_year is not None
+        return crypto_pool_gain_loss_rows(tax_year, cash_app_files=[filename], designations=designations,
+                                          aggregate=aggregate, audit=audit)
+    cash_app_btc = cached_parse(parse_cash_app_report, filename).sort_values('Date', kind='stable')
+    if tax_year is not None:
+        cash_app_btc = cash_app_btc[cash_app_btc['Date'].dt.year == tax_year]
+    dates = to_ordinals(cash_app_btc['Date'])
+    assert (cash_app_btc['Symbol'] == "BTC").all()
+    is_buy = (cash_app_btc['Transaction Type'] == "Bitcoin Boost").to_numpy()
+    assert (is_buy | (cash_app_btc['Transaction Type'] == "Bitcoin Sale").to_numpy()).all()
+    quantity = cash_app_btc['Quantity'].to_numpy()
+    amount = cash_app_btc['Amount'].to_numpy()
+    position = np.arange(len(quantity))
+    # FIFO
+    # Cryptocurrency is exempt from wash sale rules. See also:
+    # https://ttlc.intuit.com/turbotax-support/en-us/help-article/cryptocurrency/wash-sale-rule-cryptocurrency/L1d6BuQpH_US_en_US
+    # 1040-NR Schedule NEC does not need to distinguish between short/long term, see holding_periods() otherwise.
+    lot, sale, current_amount = fifo_match(quantity[is_buy], quantity[~is_buy])
+    assert (position[is_buy][lot] < position[~is_buy][sale]).all()
     # XXX: assume the amounts of BTC at the beginning and at the end of the year are both 0
-    for index, row in cash_app_btc.iterrows():
-        tzinfos = {"EST": dateutil.tz.gettz('America/Eastern'),
-                   "EDT": dateutil.tz.gettz('America/Eastern')}
-        date = dateutil.parser.parse(row['Date'], tzinfos=tzinfos)
-        if tax_year is not None and date.year != tax_year:
-            continue
-        date = date.strftime("%m/%d/%Y")
-        assert row['Symbol'] == "BTC"
-        if row['Action'] == "Bitcoin Boost":
-            # FIFO
-            asset.append(
-                [date, float(row['Quantity']), float(row['Amount'][1:].replace(',', '')) / float(row['Quantity'])])
-            print(f"Buy {float(row['Quantity'])}")
-            continue
-        assert row['Action'] == "Bitcoin Sale"
-        sold_amount = float(row['Quantity'])
-        unit_price = float(row['Amount'][1:].replace(',', '')) / sold_amount
-        total_proceeds += float(row['Amount'][1:].replace(',', ''))
-        print(f"Sell {float(row['Quantity'])}")
-        while sold_amount > EPS:
-            assert len(asset) > 0
-            current_amount = min(sold_amount, asset[0][1])
-            # Cryptocurrency is exempt from wash sale rules. See also:
-            # https://ttlc.intuit.com/turbotax-support/en-us/help-article/cryptocurrency/wash-sale-rule-cryptocurrency/L1d6BuQpH_US_en_US
-            # This script cannot distinguish between short/long term.
-            # 1040-NR Schedule NEC does not need to detect it.
-            sales_price = unit_price * current_amount
-            cost = asset[0][2] * current_amount
-            loss = max(0, cost - sales_price)
-            gain = max(0, sales_price - cost)
-            total_gain_loss += gain - loss
-            new_item = pd.Series(
-                {'(a) Kind of property and description': f'{current_amount:.9f} BTC (Cash App)',
-                 '(b) Date acquired': asset[0][0],
-                 '(c) Date sold': date, '(d) Sales price': sales_price,
-                 '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain})
-            gain_loss = append_row(gain_loss, new_item)
-            asset[0][1] -= current_amount
-            if asset[0][1] <= EPS:
-                asset.popleft()
-            sold_amount -= current_amount
-    assert len(asset) == 0
+    remaining = quantity[is_buy] - np.bincount(lot, weights=current_amount, minlength=is_buy.sum())
+    assert (remaining <= EPS).all()
+    sales_price = (amount[~is_buy] / quantity[~is_buy])[sale] * current_amount
+    cost = (amount[is_buy] / quantity[is_buy])[lot] * current_amount
+    if aggregate is None and audit is None:
+        new_items = gain_loss_rows([f'{x:.9f} BTC (Cash App)' for x in current_amount],
+                                   dates[is_buy][lot], dates[~is_buy][sale], sales_price, cost, 'Cash App')
+    else:
+        realized_rows = RealizedRows(aggregate, audit)
+        realized_rows.add_many(position[~is_buy][sale], current_amount, 'BTC', 'Cash App', dates[is_buy][lot],
+                               dates[~is_buy][sale], sales_price, cost)
+        new_items = realized_rows.gain_loss_rows()
+    total_proceeds = amount[~is_buy].sum()
+    total_gain_loss = (new_items['(g) GAIN'] - new_items['(f) LOSS']).sum()
     print(f'Computed Cash App Bitcoin with total proceeds {total_proceeds} and total gain/loss {total_gain_loss}.')
+    return new_items
+
+
+def read_and_compute_cash_app_btc(filename='cash_app_report_btc.csv', tax_year=None, designations=None, aggregate=None,
+                                  audit=None):
+    global gain_loss
+    gain_loss = append_rows(gain_loss, cash_app_btc_gain_loss_rows(filename, tax_year, designations, aggregate, audit))
 
 
 def get_high_cost(q, sold_amount):
@@ -138,273 +455,867 @@ def get_low_cost(q, sold_amount):
     return current_amount, q_list[idx][2] * current_amount, q_list[idx][0]  # amount, cost, date
 
 
-def read_and_compute_robinhood_crypto(filenames, tax_year, filter=None, transfers=None, tax_harvest_years=None):
-    # tax harvesting: use high cost on sales and low costs on outbound transfers in these years, or FIFO otherwise
-    global gain_loss
+class Lots:
+    # Open lots of one asset that can be taken in FIFO, LIFO, highest-cost (HIFO) or lowest-cost (LOFO) order.
+    # Each lot is [date acquired, quantity, unit cost, sequence number, lot ID] and is shared by all the orderings;
+    # a lot emptied through one ordering is dropped from the others when it reaches their front,
+    # so every take costs O(log n) instead of a scan over the lots. Lots with an ID are also indexed by it,
+    # so a designated lot is taken in O(1).
+    # quantity and cost are the running totals of the open lots. With journal=True, the totals after each change
+    # are also kept by date (changes must come in time order), so holding() at any date costs O(log n).
+
+    def __init__(self, journal=False):
+        self.queue = deque()
+        self.high = []
+        self.low = []
+        self.count = 0
+        self.by_id = {}
+        self.quantity = 0.0
+        self.cost = 0.0
+        self.journal_dates = [] if journal else None
+        self.journal_totals = [] if journal else None
+
+    def record(self, date):
+        if self.journal_dates is None or date is None:
+            return
+        if len(self.journal_dates) > 0 and self.journal_dates[-1] == date:
+            self.journal_totals[-1] = (self.quantity, self.cost)
+            return
+        assert len(self.journal_dates) == 0 or self.journal_dates[-1] < date
+        self.journal_dates.append(date)
+        self.journal_totals.append((self.quantity, self.cost))
+
+    def holding(self, date):
+        # (quantity, total cost) at the end of the date (an ordinal)
+        assert self.journal_dates is not None
+        i = bisect_right(self.journal_dates, date)
+        return self.journal_totals[i - 1] if i > 0 else (0.0, 0.0)
+
+    def add(self, date, quantity, unit_cost, lot_id=None):
+        lot = [date, quantity, unit_cost, self.count, lot_id]
+        self.count += 1
+        if lot_id is not None:
+            assert lot_id not in self.by_id, f'Duplicate lot ID {lot_id}'
+            self.by_id[lot_id] = lot
+        self.queue.append(lot)
+        heappush(self.high, (-unit_cost, lot[3], lot))
+        heappush(self.low, (unit_cost, lot[3], lot))
+        self.quantity += quantity
+        self.cost += quantity * unit_cost
+        self.record(date)
+
+    def front(self, method):
+        if method == 'FIFO':
+            while len(self.queue) > 0 and self.queue[0][1] <= EPS:
+                self.queue.popleft()
+            return self.queue[0] if len(self.queue) > 0 else None
+        if method == 'LIFO':
+            while len(self.queue) > 0 and self.queue[-1][1] <= EPS:
+                self.queue.pop()
+            return self.queue[-1] if len(self.queue) > 0 else None
+        heap = self.high if method == 'HIFO' else self.low
+        assert method in ['HIFO', 'LOFO']
+        while len(heap) > 0 and heap[0][2][1] <= EPS:
+            heappop(heap)
+        return heap[0][2] if len(heap) > 0 else None
+
+    def take(self, quantity, method, date=None, designated=()):
+        # Yields (amount, cost, date acquired) of each piece taken; date (an ordinal) is needed for the journal
+        # designated: (lot ID, quantity) taken first, the rest is taken by the method
+        for lot_id, lot_quantity in designated:
+            assert lot_id in self.by_id, f'Unknown lot ID {lot_id}'
+            lot = self.by_id[lot_id]
+            assert lot[1] >= lot_quantity - EPS, f'Lot {lot_id} has only {lot[1]} left, {lot_quantity} designated'
+            current_amount = min(quantity, lot_quantity, lot[1])
+            quantity -= current_amount
+            yield self.take_from(lot, current_amount)
+        while quantity > EPS:
+            lot = self.front(method)
+            assert lot is not None
+            current_amount = min(quantity, lot[1])
+            quantity -= current_amount
+            yield self.take_from(lot, current_amount)
+        if self.quantity <= EPS:
+            # No drift once everything is gone
+            self.quantity = 0.0
+            self.cost = 0.0
+        self.record(date)
+
+    def take_from(self, lot, amount):
+        lot[1] -= amount
+        self.quantity -= amount
+        self.cost -= lot[2] * amount
+        return amount, lot[2] * amount, lot[0]
+
+    def __iter__(self):
+        return (lot for lot in self.queue if lot[1] > EPS)
+
+
+def to_lots(lots):
+    # Lots with the open ones of the given [date acquired, quantity, unit cost]
+    result = Lots()
+    for date, quantity, unit_cost in lots:
+        if quantity > EPS:
+            result.add(date, quantity, unit_cost)
+    return result
+
+
+def activity_hashes(activity):
+    # A stable 64-bit hash of the fields identifying each fill, computed on the text as exported:
+    # the key columns must be read as strings, or the same quantity may read 100 in one file and 100.0 in another
+    return pd.util.hash_pandas_object(activity[robinhood_crypto_key_columns].astype(str), index=False).to_numpy()
+
+
+def parse_robinhood_crypto_activity(filename):
+    # The rows of a Robinhood crypto activity file, newest first as exported, with the Hash of each fill
+    # (see activity_hashes()). Only the filled orders have their dates and amounts parsed.
+    activity = pd.read_csv(filename, dtype={column: str for column in robinhood_crypto_key_columns})
+    filled = (activity['State'] == 'Filled').to_numpy()
+    dates = np.full(len(activity), np.datetime64('NaT'), dtype='datetime64[ns]')
+    dates[filled] = parse_dates(activity['Time Entered'][filled]).to_numpy()
+    quantity, leaves_quantity, amount = np.full((3, len(activity)), np.nan)
+    quantity[filled] = activity['Quantity'][filled].astype(float).to_numpy()
+    leaves_quantity[filled] = activity['Leaves Quantity'][filled].astype(float).to_numpy()
+    # -$x.xx or ($x.xx) for buys, $x.xx for sells
+    amount[filled] = activity['Notional'][filled].str.replace(r'[-$(),\s]', '', regex=True).astype(float).to_numpy()
+    return pd.DataFrame({
+        'Hash': activity_hashes(activity),
+        'Filled': filled,
+        'Date': dates,
+        'Symbol': activity['Symbol'].to_numpy(),
+        'Side': activity['Side'].to_numpy(),
+        'Quantity': quantity,
+        'Leaves Quantity': leaves_quantity,
+        'Amount': amount})
+
+
+def read_robinhood_crypto_activities(filenames):
+    # Robinhood exports overlap across years, so a fill already seen in an earlier file is dropped.
+    # Repeats within one file are kept: they are separate fills unless another file says otherwise.
+    seen = np.empty(0, dtype=np.uint64)  # sorted hashes of the fills read so far
+    activities = []
+    for filename in filenames:
+        activity = cached_parse(parse_robinhood_crypto_activity, filename)
+        hashes = activity['Hash'].to_numpy()
+        is_new = ~np.isin(hashes, seen)
+        if not is_new.all():
+            print(f'Dropped {(~is_new).sum()} fills of {filename} already in another file.')
+        activities.append(activity[is_new])
+        seen = np.union1d(seen, hashes)
+    return pd.concat(activities)
+
+
+def read_robinhood_crypto_events(filenames, transfers=None):
+    # Returns the filled orders and the transfers as one time-sorted table with the columns
+    # Date, Symbol, Side (Buy, Sell, Received or Sent), Quantity and Amount.
+    # Amount is the notional of an order, the cost basis of a received transfer,
+    # or the price if sold of a sent transfer (NaN if it is not treated as sold).
     assert len(filenames) > 0
-    activities = [pd.read_csv(filename) for filename in filenames]
-    if filter is not None:
-        # Sometimes Robinhood includes activities not in the tax year.
-        # We filter each file according to the years to avoid duplicates.
-        for i in range(len(filenames)):
-            if i in filter.keys():
-                activities[i] = activities[i][
-                    activities[i].apply(lambda x: dateutil.parser.parse(x['Time Entered']).year in filter[i], axis=1)]
-    robinhood_gain_loss = pd.concat(activities)
-    transfer_history = pd.DataFrame(columns=transfer_history_columns)
+    # Robinhood lists the newest activity first
+    robinhood_crypto = read_robinhood_crypto_activities(filenames)[::-1]
+    robinhood_crypto = robinhood_crypto[robinhood_crypto['Filled']]
+    assert (robinhood_crypto['Leaves Quantity'] == 0).all()
+    assert robinhood_crypto['Side'].isin(['Buy', 'Sell']).all()
+    events = [robinhood_crypto[['Date', 'Symbol', 'Side', 'Quantity', 'Amount']]]
     if transfers is not None:
-        transfer_history = pd.read_csv(transfers)
-    transfer_id = 0
-    asset = {}
-    total_gain_loss = 0
-    transfer_date = None
-
-    def process_transfer():
-        nonlocal transfer_id, notional, cost, current_amount, transfer_date, new_item, date_acquired, total_gain_loss
-        global gain_loss
-        # we now process the transfer
-        if transfer_row['Symbol'] not in asset.keys():
-            print('New cryptocurrency:', transfer_row['Symbol'])
-            asset[transfer_row['Symbol']] = deque()
-        q = asset[transfer_row['Symbol']]
-        treat_as_sold = 'Price if sold' in transfer_row.keys() and (transfer_row['Price if sold'] is not None)
-        if transfer_row['Side'] == 'Received':
-            # FIFO
-            notional = float(transfer_row['Cost Basis'])
-            q.append(
-                [transfer_date_str, float(transfer_row['Quantity']), notional / float(transfer_row['Quantity'])])
-            print(f"Received {float(transfer_row['Quantity'])} {transfer_row['Symbol']} with unit price "
-                  f"{notional / float(transfer_row['Quantity'])} (total {notional})")
-        else:
-            assert transfer_row['Side'] == 'Sent'
-            cost = 0.0
-            sent_amount = transfer_row['Quantity']
-            while sent_amount > EPS:
-                assert len(q) > 0
-                if tax_harvest_years is None or year not in tax_harvest_years:
-                    # FIFO
-                    current_amount = min(sent_amount, q[0][1])
-                    cost += q[0][2] * current_amount
-                    q[0][1] -= current_amount
-                    date_acquired = q[0][0]
-                    if q[0][1] <= EPS:
-                        q.popleft()
-                    sent_amount -= current_amount
-                else:
-                    current_amount, current_cost, date_acquired = get_high_cost(q, sent_amount) if treat_as_sold else get_low_cost(q, sent_amount)
-                    sent_amount -= current_amount
-                    cost += current_cost
-                if year == tax_year and 'Price if sold' in transfer_row.keys() and transfer_row['Price if sold']:
-                    sent_price = float(transfer_row['Price if sold']) / transfer_row['Quantity'] * current_amount
-                    loss = max(0, cost - sent_price)
-                    gain = max(0, sent_price - cost)
-                    total_gain_loss += gain - loss
-                    if loss < EPS and gain < EPS and transfer_row["Symbol"] in stable_coins:
-                        pass
-                    else:
-                        new_item = pd.Series(
-                            {'(a) Kind of property and description': f'{current_amount:.9f} {transfer_row["Symbol"]} (Robinhood)',
-                             '(b) Date acquired': date_acquired,
-                             '(c) Date sold': transfer_date.strftime("%m/%d/%Y"), '(d) Sales price': sent_price,
-                             '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain})
-                        gain_loss = append_row(gain_loss, new_item)
-            print(f"Sent {transfer_row['Quantity']} {transfer_row['Symbol']} with unit price "
-                  f"{cost / transfer_row['Quantity']} (total {cost})")
+        # Transfers go first so that they are processed before orders at the same time
+        events.insert(0, read_crypto_transfers(transfers)[['Date', 'Symbol', 'Side', 'Quantity', 'Amount']])
+    return pd.concat(events).sort_values('Date', kind='stable').reset_index(drop=True)
 
-    for index, row in robinhood_gain_loss[::-1].iterrows():
-        if row['State'] != 'Filled':
-            continue
-        date = dateutil.parser.parse(row['Time Entered'])
-        year = date.year
-        while transfer_id < len(transfer_history):
-            transfer_row = transfer_history.iloc[transfer_id]
-            transfer_date = dateutil.parser.parse(transfer_row['Date'])
-            transfer_date_str = transfer_date.strftime("%m/%d/%Y")
-            if transfer_date > date:
-                break
-            process_transfer()
-            transfer_id += 1
-        date = date.strftime("%m/%d/%Y")
-        if year > tax_year:
-            break
-        if row['Symbol'] not in asset.keys():
-            print('New cryptocurrency:', row['Symbol'])
-            asset[row['Symbol']] = deque()
-        assert row['Leaves Quantity'] == 0
-        q = asset[row['Symbol']]
-        if row['Side'] == 'Buy':
+
+def read_crypto_transfers(filename, platform='Robinhood'):
+    # Same columns as read_robinhood_crypto_events(), plus the Platform of each transfer:
+    # the optional Platform column of the file (e.g., a self-custody wallet), or the given platform otherwise
+    transfer_history = pd.read_csv(filename)
+    assert transfer_history['Side'].isin(['Received', 'Sent']).all()
+    price_if_sold = transfer_history['Price if sold'] if 'Price if sold' in transfer_history.columns else np.nan
+    return pd.DataFrame({
+        'Date': parse_dates(transfer_history['Date']).to_numpy(),
+        'Symbol': transfer_history['Symbol'].to_numpy(),
+        'Side': transfer_history['Side'].to_numpy(),
+        'Quantity': transfer_history['Quantity'].astype(float).to_numpy(),
+        'Amount': np.where(transfer_history['Side'] == 'Received', transfer_history['Cost Basis'],
+                           price_if_sold).astype(float),
+        'Platform': transfer_history['Platform'].fillna(platform).to_numpy()
+        if 'Platform' in transfer_history.columns else platform})
+
+
+def robinhood_crypto_gain_loss_rows(filenames, tax_year, transfers=None, tax_harvest_years=None,
+                                    optimize_tax_harvest=False, designations=None, aggregate=None, audit=None):
+    # tax harvesting: use high cost on sales and low costs on outbound transfers in these years, or FIFO otherwise
+    # optimize_tax_harvest: choose the lots of the tax harvesting years with replay_robinhood_crypto_optimized()
+    # and report the saving relative to FIFO and to the greedy rules
+    # designations: a .csv file of lots designated for sales and outbound transfers (lot_designation_columns);
+    # the rest is taken as above, with the optimal tax harvesting lots
+    # aggregate, audit: see RealizedRows
+    # Returns the rows of gain_loss in the tax year
+    if designations is not None:
+        return robinhood_crypto_gain_loss_rows_by_year(filenames, [tax_year], transfers, tax_harvest_years or (),
+                                                       designations, aggregate, audit)[tax_year]
+    events = read_robinhood_crypto_events(filenames, transfers)
+    events = events[events['Date'].dt.year <= tax_year]
+    # Cryptocurrency is exempt from wash sale rules. See also:
+    # https://ttlc.intuit.com/turbotax-support/en-us/help-article/cryptocurrency/wash-sale-rule-cryptocurrency/L1d6BuQpH_US_en_US
+    # 1040-NR Schedule NEC does not need to distinguish between short/long term, see holding_periods() otherwise.
+    realized_rows = None if aggregate is None and audit is None else RealizedRows(aggregate, audit)
+    if tax_harvest_years is None or all(year > tax_year for year in tax_harvest_years):
+        asset, new_items = replay_robinhood_crypto_fifo(events, tax_year, realized_rows=realized_rows)
+    elif optimize_tax_harvest:
+        asset, new_items = replay_robinhood_crypto_optimized(events, tax_year, tax_harvest_years,
+                                                             realized_rows=realized_rows)
+    else:
+        asset, new_items = replay_robinhood_crypto(events, tax_year, tax_harvest_years, realized_rows=realized_rows)
+    total_gain_loss = (new_items['(g) GAIN'] - new_items['(f) LOSS']).sum()
+    if optimize_tax_harvest:
+        fifo_gain_loss = total_gain_loss
+        greedy_gain_loss = total_gain_loss
+        if tax_harvest_years is not None and any(year <= tax_year for year in tax_harvest_years):
+            fifo_items = replay_robinhood_crypto_fifo(events, tax_year, verbose=False)[1]
+            fifo_gain_loss = (fifo_items['(g) GAIN'] - fifo_items['(f) LOSS']).sum()
+            greedy_items = replay_robinhood_crypto(events, tax_year, tax_harvest_years, verbose=False)[1]
+            greedy_gain_loss = (greedy_items['(g) GAIN'] - greedy_items['(f) LOSS']).sum()
+        print(f'Optimized Robinhood crypto gain/loss in {tax_year}: {total_gain_loss} '
+              f'(saving {fifo_gain_loss - total_gain_loss} relative to FIFO ({fifo_gain_loss}), '
+              f'{greedy_gain_loss - total_gain_loss} relative to the greedy rules ({greedy_gain_loss})).')
+    show_remaining_crypto(asset, tax_year)
+    print(f'Computed Robinhood crypto with total gain/loss {total_gain_loss}.')
+    return new_items
+
+
+def show_remaining_crypto(asset, tax_year):
+    # asset: {symbol: Lots}
+    for symbol, q in asset.items():
+        if q.quantity > EPS:
+            print(
+                f'Remaining {symbol} as of the end of year {tax_year}: quantity={q.quantity}, average cost={q.cost / q.quantity}, total cost={q.cost}')
+
+
+def read_and_compute_robinhood_crypto(filenames, tax_year, transfers=None, tax_harvest_years=None,
+                                      optimize_tax_harvest=False, designations=None, aggregate=None, audit=None):
+    global gain_loss
+    gain_loss = append_rows(gain_loss, robinhood_crypto_gain_loss_rows(
+        filenames, tax_year, transfers, tax_harvest_years, optimize_tax_harvest, designations, aggregate, audit))
+
+
+def replay_robinhood_crypto(events, tax_year, tax_harvest_years, verbose=True, realized_rows=None):
+    # Replays the events lot by lot, switching between FIFO and tax harvesting by year.
+    # Returns the remaining Lots of each symbol and the rows realized in the tax year (see RealizedRows).
+    realized_rows = RealizedRows() if realized_rows is None else realized_rows
+    asset = {}
+    for position, (date, symbol, side, quantity, amount) in enumerate(events.itertuples(index=False)):
+        if symbol not in asset.keys():
+            if verbose:
+                print('New cryptocurrency:', symbol)
+            asset[symbol] = deque()
+        q = asset[symbol]
+        ordinal = date.toordinal()
+        if side == 'Buy' or side == 'Received':
             # FIFO
-            if row['Notional'].strip()[0] == '-':
-                notional = float(row['Notional'].strip()[2:])  # -$x.xx
-            else:
-                assert row['Notional'].strip()[0] == '('
-                assert row['Notional'].strip()[-1] == ')'
-                notional = float(row['Notional'].strip()[2:-1])  # ($x.xx)
-            q.append(
-                [date, float(row['Quantity']), notional / float(row['Quantity'])])
-            print(f"Buy {float(row['Quantity'])} {row['Symbol']} with unit price {notional / float(row['Quantity'])}")
+            q.append([ordinal, quantity, amount / quantity])
+            if side == 'Received' and verbose:
+                print(f"Received {quantity} {symbol} with unit price {amount / quantity} (total {amount})")
             continue
-        assert row['Side'] == 'Sell'
-        notional = float(row['Notional'].strip()[1:])  # $x.xx
-        sold_amount = float(row['Quantity'])
-        unit_price = notional / sold_amount
-        print(f"Sell {sold_amount} {row['Symbol']} with unit price {unit_price}")
+        treat_as_sold = side == 'Sell' or not np.isnan(amount)
+        sold_amount = quantity
+        total_cost = 0.0
         while sold_amount > EPS:
             assert len(q) > 0
-            cost = 0
-            if tax_harvest_years is None or transfer_date.year not in tax_harvest_years:
+            if date.year not in tax_harvest_years:
                 # FIFO
                 current_amount = min(sold_amount, q[0][1])
-                # Cryptocurrency is exempt from wash sale rules. See also:
-                # https://ttlc.intuit.com/turbotax-support/en-us/help-article/cryptocurrency/wash-sale-rule-cryptocurrency/L1d6BuQpH_US_en_US
-                # This script cannot distinguish between short/long term.
-                # 1040-NR Schedule NEC does not need to detect it.
-                sales_price = unit_price * current_amount
                 cost = q[0][2] * current_amount
                 q[0][1] -= current_amount
                 date_acquired = q[0][0]
                 if q[0][1] <= EPS:
                     q.popleft()
             else:
-                current_amount, cost, date_acquired = get_high_cost(q, sold_amount)
-                sales_price = unit_price * current_amount
+                current_amount, cost, date_acquired = get_high_cost(q, sold_amount) if treat_as_sold else get_low_cost(q, sold_amount)
             sold_amount -= current_amount
-            if year == tax_year:
-                loss = max(0, cost - sales_price)
-                gain = max(0, sales_price - cost)
-                total_gain_loss += gain - loss
-                if loss < EPS and gain < EPS and row["Symbol"] in stable_coins:
-                    pass
-                else:
-                    new_item = pd.Series(
-                        {'(a) Kind of property and description': f'{current_amount:.9f} {row["Symbol"]} (Robinhood)',
-                         '(b) Date acquired': date_acquired,
-                         '(c) Date sold': date, '(d) Sales price': sales_price,
-                         '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain})
-                    gain_loss = append_row(gain_loss, new_item)
-    while transfer_id < len(transfer_history):
-        transfer_row = transfer_history.iloc[transfer_id]
-        transfer_date = dateutil.parser.parse(transfer_row['Date'])
-        transfer_date_str = transfer_date.strftime("%m/%d/%Y")
-        process_transfer()
-        transfer_id += 1
-    for symbol, q in asset.items():
-        cost = 0
-        quantity = 0
-        for item in q:
-            quantity += item[1]
-            cost += item[1] * item[2]
-        if quantity > 0:
-            print(
-                f'Remaining {symbol} as of the end of year {tax_year}: quantity={quantity}, average cost={cost / quantity}, total cost={cost}')
-    print(f'Computed Robinhood crypto with total gain/loss {total_gain_loss}.')
+            total_cost += cost
+            if treat_as_sold and date.year == tax_year:
+                sales_price = amount / quantity * current_amount
+                if abs(sales_price - cost) < EPS and symbol in stable_coins:
+                    continue
+                realized_rows.add(position, current_amount, symbol, 'Robinhood', date_acquired, ordinal, sales_price,
+                                  cost)
+        if side == 'Sent' and verbose:
+            print(f"Sent {quantity} {symbol} with unit price {total_cost / quantity} (total {total_cost})")
+    asset = {symbol: to_lots(q) for symbol, q in asset.items()}
+    return asset, realized_rows.gain_loss_rows()
 
 
-def read_and_compute_robinhood_gain_loss(filename):
+def replay_robinhood_crypto_optimized(events, tax_year, tax_harvest_years, verbose=True, realized_rows=None):
+    # Same as replay_robinhood_crypto(), but minimizes the realized net gain of each tax harvesting year.
+    # The proceeds are fixed, so this maximizes the cost basis taken by sales and transfers treated as sold.
+    # Taking the highest-cost open lot for those and the lowest-cost open lot for other outbound transfers,
+    # in time order, is optimal: any lot open at a disposal is still open at every later one, so swapping
+    # lots between two disposals of an optimal assignment towards this rule never lowers the cost basis sold.
+    # With Lots, each piece costs O(log n) instead of the O(n) scan of get_high_cost()/get_low_cost().
+    realized_rows = RealizedRows() if realized_rows is None else realized_rows
+    asset = {}
+    for position, (date, symbol, side, quantity, amount) in enumerate(events.itertuples(index=False)):
+        if symbol not in asset.keys():
+            if verbose:
+                print('New cryptocurrency:', symbol)
+            asset[symbol] = Lots()
+        ordinal = date.toordinal()
+        if side == 'Buy' or side == 'Received':
+            asset[symbol].add(ordinal, quantity, amount / quantity)
+            if side == 'Received' and verbose:
+                print(f"Received {quantity} {symbol} with unit price {amount / quantity} (total {amount})")
+            continue
+        treat_as_sold = side == 'Sell' or not np.isnan(amount)
+        method = 'FIFO'
+        if date.year in tax_harvest_years:
+            method = 'HIFO' if treat_as_sold else 'LOFO'
+        total_cost = 0.0
+        for current_amount, cost, date_acquired in asset[symbol].take(quantity, method, ordinal):
+            total_cost += cost
+            if treat_as_sold and date.year == tax_year:
+                sales_price = amount / quantity * current_amount
+                if abs(sales_price - cost) < EPS and symbol in stable_coins:
+                    continue
+                realized_rows.add(position, current_amount, symbol, 'Robinhood', date_acquired, ordinal, sales_price,
+                                  cost)
+        if side == 'Sent' and verbose:
+            print(f"Sent {quantity} {symbol} with unit price {total_cost / quantity} (total {total_cost})")
+    return asset, realized_rows.gain_loss_rows()
+
+
+def replay_robinhood_crypto_fifo(events, tax_year, verbose=True, realized_rows=None):
+    # Same as replay_robinhood_crypto() with FIFO in every year, but splits all disposals of a symbol at once.
+    # Without realized_rows, the rows are built directly from the arrays of pieces.
+    asset = {}
+    new_items = []
+    order = []
+    for symbol, symbol_events in events.groupby('Symbol', sort=False):
+        if verbose:
+            print('New cryptocurrency:', symbol)
+        side = symbol_events['Side'].to_numpy()
+        is_lot = (side == 'Buy') | (side == 'Received')
+        quantity = symbol_events['Quantity'].to_numpy()
+        amount = symbol_events['Amount'].to_numpy()
+        year = symbol_events['Date'].dt.year.to_numpy()
+        ordinal = to_ordinals(symbol_events['Date'])
+        position = symbol_events.index.to_numpy()
+        lot, sale, current_amount = fifo_match(quantity[is_lot], quantity[~is_lot])
+        assert (position[is_lot][lot] < position[~is_lot][sale]).all()
+        unit_cost = amount[is_lot] / quantity[is_lot]
+        cost = unit_cost[lot] * current_amount
+        for i in np.flatnonzero((side == 'Received') & verbose):
+            print(f"Received {quantity[i]} {symbol} with unit price {amount[i] / quantity[i]} (total {amount[i]})")
+        total_cost = np.bincount(sale, weights=cost, minlength=(~is_lot).sum())
+        for i, sent_cost in zip(np.flatnonzero(~is_lot), total_cost):
+            if side[i] == 'Sent' and verbose:
+                print(f"Sent {quantity[i]} {symbol} with unit price {sent_cost / quantity[i]} (total {sent_cost})")
+        remaining = quantity[is_lot] - np.bincount(lot, weights=current_amount, minlength=is_lot.sum())
+        asset[symbol] = to_lots(zip(ordinal[is_lot], remaining, unit_cost))
+        treat_as_sold = (side[~is_lot] == 'Sell') | ~np.isnan(amount[~is_lot])
+        realized = (treat_as_sold & (year[~is_lot] == tax_year))[sale]
+        sales_price = (amount[~is_lot] / quantity[~is_lot])[sale] * current_amount
+        if symbol in stable_coins:
+            realized &= np.abs(sales_price - cost) >= EPS
+        if realized_rows is not None:
+            realized_rows.add_many(position[~is_lot][sale[realized]], current_amount[realized], symbol, 'Robinhood',
+                                   ordinal[is_lot][lot[realized]], ordinal[~is_lot][sale[realized]],
+                                   sales_price[realized], cost[realized])
+            continue
+        new_items.append(gain_loss_rows([f'{x:.9f} {symbol} (Robinhood)' for x in current_amount[realized]],
+                                        ordinal[is_lot][lot[realized]], ordinal[~is_lot][sale[realized]],
+                                        sales_price[realized], cost[realized], 'Robinhood'))
+        order.append(position[~is_lot][sale[realized]])
+    if realized_rows is not None:
+        return asset, realized_rows.gain_loss_rows()
+    if len(new_items) == 0:
+        return asset, gain_loss_rows([], [], [], [], [], 'Robinhood')
+    # Interleave the symbols back into the order of the disposals
+    new_items = pd.concat(new_items)
+    return asset, new_items.iloc[np.argsort(np.concatenate(order), kind='stable')].reset_index(drop=True)
+
+
+def compare_robinhood_crypto_methods(filenames, transfers=None, methods=None, filename=None):
+    # What-if comparison of cost basis methods: parses the activities and transfers once, then feeds every event
+    # to one independent set of lots per method in a single pass.
+    # Returns (and optionally saves) the gain/loss of each method per year and symbol, with yearly totals.
+    if methods is None:
+        methods = list(cost_basis_methods.keys())
+    events = read_robinhood_crypto_events(filenames, transfers)
+    assets = {method: {} for method in methods}
+    realized = {method: {} for method in methods}
+    for date, symbol, side, quantity, amount in events.itertuples(index=False):
+        if side == 'Buy' or side == 'Received':
+            ordinal = date.toordinal()
+            for method in methods:
+                assets[method].setdefault(symbol, Lots()).add(ordinal, quantity, amount / quantity)
+            continue
+        treat_as_sold = side == 'Sell' or not np.isnan(amount)
+        for method in methods:
+            lots = assets[method].setdefault(symbol, Lots())
+            cost = sum(piece[1] for piece in lots.take(quantity, cost_basis_methods[method][0 if treat_as_sold else 1]))
+            if treat_as_sold:
+                key = (date.year, symbol)
+                realized[method][key] = realized[method].get(key, 0.0) + amount - cost
+    comparison = pd.DataFrame(realized, columns=methods).fillna(0.0)
+    if len(comparison) > 0:
+        comparison.index.names = ['Year', 'Symbol']
+        totals = comparison.groupby(level='Year').sum()
+        totals.index = pd.MultiIndex.from_arrays([totals.index, ['Total'] * len(totals)], names=['Year', 'Symbol'])
+        comparison = pd.concat([comparison, totals]).sort_index(level='Year', sort_remaining=False, kind='stable')
+    print(comparison.to_string())
+    if filename is not None:
+        comparison.to_csv(filename)
+    return comparison
+
+
+def read_cash_app_crypto_events(filename='cash_app_report_btc.csv'):
+    # Same columns as read_robinhood_crypto_events() for a Cash App report.
+    # Amount is NaN for withdrawals and deposits: their basis comes from the linked transfer on the other platform.
+    cash_app = cached_parse(parse_cash_app_report, filename)
+    side = cash_app['Transaction Type'].map(cash_app_sides)
+    assert side.notna().all()
+    return pd.DataFrame({
+        'Date': cash_app['Date'].to_numpy(),
+        'Symbol': cash_app['Symbol'].to_numpy(),
+        'Side': side.to_numpy(),
+        'Quantity': cash_app['Quantity'].to_numpy(),
+        'Amount': np.where(side.isin(['Buy', 'Sell']), cash_app['Amount'], np.nan),
+        'Platform': 'Cash App'}).sort_values('Date', kind='stable').reset_index(drop=True)
+
+
+def link_crypto_transfers(streams):
+    # Links each transfer sent from one platform to the first unlinked transfer of the same asset received by another
+    # platform on the same day or within TRANSFER_LINK_DAYS after it, so that the lots move instead of being
+    # disposed of and acquired again. Sets the Linked column of each stream: the quantity received for a linked
+    # sent transfer, the quantity itself for a linked received transfer, and NaN otherwise.
+    received = {}
+    sent = []
+    for k, events in enumerate(streams):
+        events['Linked'] = np.nan
+        days = to_ordinals(events['Date'])
+        for i in np.flatnonzero((events['Side'] == 'Received').to_numpy()):
+            received.setdefault(events['Symbol'].iat[i], []).append(
+                [days[i], events['Platform'].iat[i], events['Quantity'].iat[i], k, i, False])
+        for i in np.flatnonzero((events['Side'] == 'Sent').to_numpy()):
+            sent.append((days[i], events['Platform'].iat[i], events['Symbol'].iat[i], events['Quantity'].iat[i], k, i))
+    for candidates in received.values():
+        candidates.sort(key=lambda x: x[0])
+    sent.sort(key=lambda x: x[0])
+    for day, platform, symbol, quantity, k, i in sent:
+        for candidate in received.get(symbol, []):
+            if candidate[0] > day + TRANSFER_LINK_DAYS:
+                break
+            if candidate[5] or candidate[0] < day or candidate[1] == platform:
+                continue
+            if quantity * (1 - TRANSFER_FEE_TOLERANCE) - EPS <= candidate[2] <= quantity + EPS:
+                candidate[5] = True
+                streams[k].iat[i, streams[k].columns.get_loc('Linked')] = candidate[2]
+                streams[candidate[3]].iat[candidate[4], streams[candidate[3]].columns.get_loc('Linked')] = candidate[2]
+                print(f'Linked {quantity} {symbol} sent from {platform} to {candidate[1]}.')
+                break
+
+
+def read_lot_designations(filename):
+    # Returns {(date, symbol, side): [(lot ID, quantity), ...]} in the order of the file.
+    # date is the time of the disposal, or the ordinal of its day if the designation has no time.
+    # Disposals with the same key use up the designations in turn.
+    designation = pd.read_csv(filename)
+    assert designation['Side'].isin(['Sell', 'Sent']).all()
+    has_time = designation['Date'].astype(str).str.contains(':').to_numpy()
+    designations = {}
+    for date, with_time, symbol, side, lot_id, quantity in zip(
+            parse_dates(designation['Date']), has_time, designation['Symbol'], designation['Side'],
+            designation['Lot ID'], designation['Quantity'].astype(float)):
+        if str(lot_id).split('-', 1)[0] != symbol:
+            raise ValueError(f'Lot {lot_id} designated for a {side} of {symbol} on {date}')
+        key = (date, symbol, side) if with_time else (date.toordinal(), symbol, side)
+        designations.setdefault(key, []).append((lot_id, quantity))
+    return designations
+
+
+def pop_designations(designations, keys, quantity):
+    # The designated (lot ID, quantity) of a disposal of the quantity, removed from designations.
+    # keys: the keys of the disposal, from the most specific
+    result = []
+    for key in keys:
+        pending = designations.get(key, [])
+        while len(pending) > 0 and quantity > EPS:
+            lot_id, lot_quantity = pending[0]
+            current_amount = min(quantity, lot_quantity)
+            result.append((lot_id, current_amount))
+            quantity -= current_amount
+            if lot_quantity - current_amount <= EPS:
+                pending.pop(0)
+            else:
+                pending[0] = (lot_id, lot_quantity - current_amount)
+    return result
+
+
+def check_designations_used(designations, last_year, verbose=True):
+    # Designations left after replaying up to the end of last_year match no disposal: an error,
+    # unless they are dated after the replayed history
+    unused, later = [], 0
+    for (date, symbol, side), pending in designations.items():
+        year = datetime.date.fromordinal(date).year if isinstance(date, int) else date.year
+        for lot_id, quantity in pending:
+            if year > last_year:
+                later += 1
+            else:
+                unused.append(f'{quantity} of {lot_id} for a {side} of {symbol} on '
+                              f'{format_date(date) if isinstance(date, int) else date}')
+    if len(unused) > 0:
+        raise ValueError('Designations matching no disposal: ' + '; '.join(unused))
+    if later > 0 and verbose:
+        print(f'Ignored {later} designations after {last_year}, the end of the replayed history.')
+
+
+def open_lots(asset):
+    # The open lots of replay_crypto_pool() with their IDs, e.g., to designate them
+    rows = [(lot[4], symbol, lot[0], lot[1], lot[2]) for symbol, lots in asset.items() for lot in lots]
+    result = pd.DataFrame(rows, columns=['Lot ID', 'Symbol', 'Date acquired', 'Quantity', 'Unit cost'])
+    result['Date acquired'] = format_dates(result['Date acquired'])
+    return result
+
+
+def merge_crypto_events(streams):
+    # k-way merge of the time-sorted streams with a heap; at the same time, earlier streams go first
+    assert all(events['Date'].is_monotonic_increasing for events in streams)
+    return (row for date, k, row in merge(
+        *[zip(events['Date'], repeat(k), events.itertuples(index=False)) for k, events in enumerate(streams)],
+        key=lambda x: (x[0], x[1])))
+
+
+def replay_crypto_pool(streams, tax_years, methods='FIFO', verbose=True, journal=False, designations=None,
+                       realized_rows=None, last_year=None):
+    # One pool of lots per asset shared by all platforms, fed by a single pass over the merged streams.
+    # A linked transfer only moves coins inside the pool, except for the network fee, which is taken out unsold.
+    # methods: a key of cost_basis_methods, or {year: key} (FIFO for the other years)
+    # journal: keep the holdings by date in the Lots, see crypto_holdings()
+    # designations: lots designated for disposals, see read_lot_designations(); each lot gets the ID
+    # {symbol}-{platform without spaces}-{yyyymmddHHMMSS acquired}-{n-th lot of the symbol acquired then on the platform},
+    # so that loading the files of another platform does not renumber the lots
+    # last_year: the streams cover the history up to the end of this year (default: the year of the last event);
+    # a designation left unused in these years is an error
+    # Returns the Lots of each asset and the rows sold in any of the tax years (see RealizedRows);
+    # their Sold column tells the year.
+    realized_rows = RealizedRows() if realized_rows is None else realized_rows
+    if not isinstance(methods, dict):
+        methods = {year: methods for year in tax_years}
+    # Copied since they are used up
+    designations = {key: list(value) for key, value in (designations or {}).items()}
+    lots_per_time = {}
+    asset = {}
+    for position, (date, symbol, side, quantity, amount, platform, linked) in enumerate(merge_crypto_events(streams)):
+        if symbol not in asset.keys():
+            if verbose:
+                print('New cryptocurrency:', symbol)
+            asset[symbol] = Lots(journal)
+        ordinal = date.toordinal()
+        sale_method, transfer_method = cost_basis_methods[methods.get(date.year, 'FIFO')]
+        if side == 'Received' and not np.isnan(linked):
+            continue
+        if side == 'Buy' or side == 'Received':
+            assert not np.isnan(amount), f'Missing cost basis of {quantity} {symbol} received by {platform} on {date}'
+            key = (symbol, platform, date)
+            n = lots_per_time[key] = lots_per_time.get(key, 0) + 1
+            asset[symbol].add(ordinal, quantity, amount / quantity,
+                              f'{symbol}-{platform.replace(" ", "")}-{date.strftime("%Y%m%d%H%M%S")}-{n}')
+            continue
+        if side == 'Sent' and not np.isnan(linked):
+            for _ in asset[symbol].take(quantity - linked, transfer_method, ordinal):
+                pass
+            continue
+        treat_as_sold = side == 'Sell' or not np.isnan(amount)
+        designated = pop_designations(designations, [(date, symbol, side), (ordinal, symbol, side)], quantity)
+        for current_amount, cost, date_acquired in asset[symbol].take(
+                quantity, sale_method if treat_as_sold else transfer_method, ordinal, designated):
+            if treat_as_sold and date.year in tax_years:
+                sales_price = amount / quantity * current_amount
+                if abs(sales_price - cost) < EPS and symbol in stable_coins:
+                    continue
+                realized_rows.add(position, current_amount, symbol, platform, date_acquired, ordinal, sales_price, cost)
+    if last_year is None:
+        last_year = max([events['Date'].iloc[-1].year for events in streams if len(events) > 0], default=0)
+    check_designations_used(designations, last_year, verbose)
+    return asset, realized_rows.gain_loss_rows()
+
+
+def crypto_pool_gain_loss_rows_by_year(tax_years, robinhood_files=(), cash_app_files=(), transfers=None,
+                                       methods='FIFO', designations=None, aggregate=None, audit=None):
+    # Consolidated crypto gain/loss across Robinhood, Cash App and transfers (e.g., from/to a self-custody wallet
+    # with Platform 'Wallet' in the transfers file), with one lot pool per asset instead of one per platform.
+    # The history is replayed once for all the tax years.
+    # methods: a key of cost_basis_methods, or {year: key} (FIFO for the other years)
+    # designations: a .csv file with lot_designation_columns (see open_lots() for the lot IDs)
+    # aggregate, audit: see RealizedRows
+    # Returns {tax year: rows of gain_loss in the year}
+    tax_years = sorted(set(tax_years))
+    asset, new_items = crypto_pool_replay(robinhood_files, cash_app_files, transfers, tax_years[-1], tax_years, methods,
+                                          designations=designations, realized_rows=RealizedRows(aggregate, audit))
+    show_remaining_crypto(asset, tax_years[-1])
+    years = ordinal_years(new_items['Sold'])
+    rows_by_year = {}
+    for tax_year in tax_years:
+        rows_by_year[tax_year] = new_items[years == tax_year].reset_index(drop=True)
+        total_gain_loss = (rows_by_year[tax_year]['(g) GAIN'] - rows_by_year[tax_year]['(f) LOSS']).sum()
+        print(f'Computed consolidated crypto in {tax_year} with total gain/loss {total_gain_loss}.')
+    return rows_by_year
+
+
+def crypto_pool_replay(robinhood_files, cash_app_files, transfers, last_year, tax_years, methods, journal=False,
+                       designations=None, realized_rows=None):
+    # Reads, links and replays the events of all platforms up to the end of last_year, see replay_crypto_pool()
+    streams = []
+    if transfers is not None:
+        # Transfers go first so that they are processed before orders at the same time.
+        # The file may not be in time order; merge_crypto_events() needs sorted streams.
+        transfer_history = read_crypto_transfers(transfers).sort_values('Date', kind='stable')
+        streams += [events.reset_index(drop=True) for _, events in transfer_history.groupby('Platform', sort=False)]
+    if len(robinhood_files) > 0:
+        streams.append(read_robinhood_crypto_events(robinhood_files).assign(Platform='Robinhood'))
+    streams += [read_cash_app_crypto_events(filename) for filename in cash_app_files]
+    streams = [events[events['Date'].dt.year <= last_year].reset_index(drop=True) for events in streams]
+    link_crypto_transfers(streams)
+    if designations is not None:
+        designations = read_lot_designations(designations)
+    return replay_crypto_pool(streams, tax_years, methods, journal=journal, designations=designations,
+                              realized_rows=realized_rows, last_year=last_year)
+
+
+def crypto_pool_gain_loss_rows(tax_year, robinhood_files=(), cash_app_files=(), transfers=None, method='FIFO',
+                               designations=None, aggregate=None, audit=None):
+    # Returns the rows of gain_loss in the tax year, see crypto_pool_gain_loss_rows_by_year()
+    return crypto_pool_gain_loss_rows_by_year([tax_year], robinhood_files, cash_app_files, transfers, method,
+                                              designations, aggregate, audit)[tax_year]
+
+
+def crypto_holdings(asset, dates):
+    # Holdings at the end of each date, from the journals of replay_crypto_pool(..., journal=True)
+    # Returns a table of Date, Symbol, Quantity, Average cost and Total cost, without the assets not held
+    rows = []
+    for date in dates:
+        ordinal = date.toordinal()
+        for symbol, lots in asset.items():
+            quantity, cost = lots.holding(ordinal)
+            if quantity > EPS:
+                rows.append((date, symbol, quantity, cost / quantity, cost))
+    return pd.DataFrame(rows, columns=['Date', 'Symbol', 'Quantity', 'Average cost', 'Total cost'])
+
+
+def crypto_pool_holdings(dates, robinhood_files=(), cash_app_files=(), transfers=None, methods='FIFO',
+                         designations=None):
+    # Holdings of the consolidated pool at the end of each date (datetime.date), with one replay for all the dates
+    # methods: a key of cost_basis_methods, or {year: key} (FIFO for the other years)
+    asset = crypto_pool_replay(robinhood_files, cash_app_files, transfers, max(dates).year, (), methods, journal=True,
+                               designations=designations)[0]
+    return crypto_holdings(asset, dates)
+
+
+def robinhood_crypto_gain_loss_rows_by_year(filenames, tax_years, transfers=None, tax_harvest_years=(),
+                                            designations=None, aggregate=None, audit=None):
+    # Same as robinhood_crypto_gain_loss_rows() with optimize_tax_harvest=True for several tax years in one replay
+    # Returns {tax year: rows of gain_loss in the year}
+    return crypto_pool_gain_loss_rows_by_year(tax_years, filenames, (), transfers,
+                                              {year: 'Tax harvest' for year in tax_harvest_years}, designations,
+                                              aggregate, audit)
+
+
+def read_and_compute_crypto_pool(tax_year, robinhood_files=(), cash_app_files=(), transfers=None, method='FIFO',
+                                 designations=None, aggregate=None, audit=None):
     global gain_loss
+    gain_loss = append_rows(gain_loss, crypto_pool_gain_loss_rows(
+        tax_year, robinhood_files, cash_app_files, transfers, method, designations, aggregate, audit))
+
+
+def parse_robinhood_gain_loss(filename):
+    # The rows of a Robinhood gain/loss report without the ="..." wrappers and the disclaimer, in the order of the file.
+    # Only Proceeds and Cost are read for sales, ST G/L for wash sales.
     robinhood_gain_loss = pd.read_csv(filename)
+    robinhood_gain_loss = robinhood_gain_loss[~robinhood_gain_loss['Symbol'].map(
+        lambda x: x.strip().startswith('The data provided is for informational'))]
+    is_wash = (robinhood_gain_loss['Event'] == 'Wash').to_numpy()
+    proceeds, cost, short_term_gain_loss = np.full((3, len(robinhood_gain_loss)), np.nan)
+    proceeds[~is_wash] = robinhood_gain_loss['Proceeds'][~is_wash].map(read_money_value).to_numpy(dtype=float)
+    cost[~is_wash] = robinhood_gain_loss['Cost'][~is_wash].map(read_money_value).to_numpy(dtype=float)
+    short_term_gain_loss[is_wash] = robinhood_gain_loss['ST G/L'][is_wash].map(read_money_value).to_numpy(dtype=float)
+    open_date = robinhood_gain_loss['Open Date'].map(remove_equal_sign)
+    closed_date = robinhood_gain_loss['Closed Date'].map(remove_equal_sign)
+    return pd.DataFrame({
+        'Wash': is_wash,
+        'Qty': robinhood_gain_loss['Qty'].map(remove_equal_sign).to_numpy(),
+        'Description': robinhood_gain_loss['Description'].map(remove_equal_sign).to_numpy(),
+        'Event': robinhood_gain_loss['Event'].map(remove_equal_sign).to_numpy(),
+        'Open Date': open_date.to_numpy(),
+        'Closed Date': closed_date.to_numpy(),
+        'Acquired': date_ordinals(open_date),
+        'Sold': date_ordinals(closed_date),
+        'Proceeds': proceeds,
+        'Cost': cost,
+        'ST G/L': short_term_gain_loss})
+
+
+def robinhood_gain_loss_rows(filename):
+    # Returns the rows of gain_loss for the file
+    rows = []
+    robinhood_gain_loss = cached_parse(parse_robinhood_gain_loss, filename)
     total_gain_loss = 0
     for index, row in robinhood_gain_loss[::-1].iterrows():
-        if row['Symbol'].strip().startswith('The data provided is for informational'):
-            continue
-        if row['Event'] == 'Wash':
-            gain = read_money_value(row['ST G/L'])
+        if row['Wash']:
+            gain = row['ST G/L']
             total_gain_loss += gain
             new_item = pd.Series({
                 '(a) Kind of property and description':
-                    f'Wash sale disallowed loss (determined by Robinhood) of {remove_equal_sign(row["Qty"])} {remove_equal_sign(row["Description"])}',
-                '(b) Date acquired': remove_equal_sign(row['Open Date']),
-                '(c) Date sold': remove_equal_sign(row['Closed Date']), '(d) Sales price': 0,
-                '(e) Cost or other basis': -gain, '(f) LOSS': 0, '(g) GAIN': gain})
+                    f'Wash sale disallowed loss (determined by Robinhood) of {row["Qty"]} {row["Description"]}',
+                '(b) Date acquired': row['Open Date'],
+                '(c) Date sold': row['Closed Date'], '(d) Sales price': 0,
+                '(e) Cost or other basis': -gain, '(f) LOSS': 0, '(g) GAIN': gain,
+                'Brokerage': 'Robinhood', 'Acquired': row['Acquired'], 'Sold': row['Sold']})
             print(f'Wash sale of {gain}.')
-            gain_loss = append_row(gain_loss, new_item)
+            rows.append(new_item)
             continue
-        sales_price = read_money_value(row['Proceeds'])
-        cost = read_money_value(row['Cost'])
+        sales_price = row['Proceeds']
+        cost = row['Cost']
         loss = max(0.0, cost - sales_price)
         gain = max(0.0, sales_price - cost)
         total_gain_loss += gain - loss
         new_item = pd.Series({
             '(a) Kind of property and description':
-                f'{remove_equal_sign(row["Qty"])} {remove_equal_sign(row["Description"])} {remove_equal_sign(row["Event"])} (Robinhood)',
-            '(b) Date acquired': remove_equal_sign(row['Open Date']),
-            '(c) Date sold': remove_equal_sign(row['Closed Date']), '(d) Sales price': sales_price,
-            '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain})
-        gain_loss = append_row(gain_loss, new_item)
+                f'{row["Qty"]} {row["Description"]} {row["Event"]} (Robinhood)',
+            '(b) Date acquired': row['Open Date'],
+            '(c) Date sold': row['Closed Date'], '(d) Sales price': sales_price,
+            '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain,
+            'Brokerage': 'Robinhood', 'Acquired': row['Acquired'], 'Sold': row['Sold']})
+        rows.append(new_item)
     print(f'Computed Robinhood gain/loss: {total_gain_loss}.')
+    return pd.DataFrame(rows, columns=gain_loss_columns + holding_period_columns)
 
 
-def read_and_compute_robinhood_gain_loss_2024(filename):
-    # Different format with 2023...
+def read_and_compute_robinhood_gain_loss(filename):
     global gain_loss
+    gain_loss = append_rows(gain_loss, robinhood_gain_loss_rows(filename))
+
+
+def parse_robinhood_gain_loss_2024(filename):
+    # The rows of a Robinhood gain/loss report since 2024 without the disclaimer, in the order of the file
     robinhood_gain_loss = pd.read_csv(filename)
+    robinhood_gain_loss = robinhood_gain_loss[~robinhood_gain_loss['Close Date'].map(
+        lambda x: x.strip().startswith('The information') or x.strip() == '')]
+    action = robinhood_gain_loss['Record Type'].map(remove_equal_sign)
+    return pd.DataFrame({
+        'Units Closed': robinhood_gain_loss['Units Closed'].map(remove_equal_sign).to_numpy(),
+        'Security': robinhood_gain_loss['Security'].map(remove_equal_sign).to_numpy(),
+        'Action': action.where(action != 'nan', 'expired').to_numpy(),
+        'Wash Sale Adjusted': ~robinhood_gain_loss['WS Cost Adj'].map(
+            lambda x: str(x).strip() in ['', 'nan']).to_numpy(dtype=bool),
+        'Acquired': date_ordinals(robinhood_gain_loss['Open Date']),
+        'Sold': date_ordinals(robinhood_gain_loss['Close Date']),
+        'Proceeds': robinhood_gain_loss['Proceeds'].map(read_money_value).to_numpy(dtype=float),
+        'Tax Cost': robinhood_gain_loss['Tax Cost'].map(read_money_value).to_numpy(dtype=float)})
+
+
+def robinhood_gain_loss_2024_rows(filename):
+    # Different format with 2023...
+    # Returns the rows of gain_loss for the file
+    rows = []
+    robinhood_gain_loss = cached_parse(parse_robinhood_gain_loss_2024, filename)
+    robinhood_gain_loss['Open Date'] = format_dates(robinhood_gain_loss['Acquired'])
+    robinhood_gain_loss['Close Date'] = format_dates(robinhood_gain_loss['Sold'])
     total_gain_loss = 0
     for index, row in robinhood_gain_loss[::-1].iterrows():
-        if row['Close Date'].strip().startswith('The information') or row['Close Date'].strip() == '':
-            continue
-        open_date = dateutil.parser.parse(row['Open Date']).strftime("%m/%d/%Y")
-        close_date = dateutil.parser.parse(row['Close Date']).strftime("%m/%d/%Y")
-        sales_price = read_money_value(row['Proceeds'])
-        cost = read_money_value(row['Tax Cost'])
+        sales_price = row['Proceeds']
+        cost = row['Tax Cost']
         loss = max(0.0, cost - sales_price)
         gain = max(0.0, sales_price - cost)
         total_gain_loss += gain - loss
-        action = remove_equal_sign(row["Record Type"])
-        if action == 'nan':
-            action = 'expired'
         new_item = pd.Series({
             '(a) Kind of property and description':
-                f'{remove_equal_sign(row["Units Closed"])} {remove_equal_sign(row["Security"])} {action} (Robinhood){"" if str(row["WS Cost Adj"]).strip() in ["", "nan"] else " (wash sale adjusted cost basis)"}',
-            '(b) Date acquired': open_date,
-            '(c) Date sold': close_date, '(d) Sales price': sales_price,
-            '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain})
-        gain_loss = append_row(gain_loss, new_item)
+                f'{row["Units Closed"]} {row["Security"]} {row["Action"]} (Robinhood){" (wash sale adjusted cost basis)" if row["Wash Sale Adjusted"] else ""}',
+            '(b) Date acquired': row['Open Date'],
+            '(c) Date sold': row['Close Date'], '(d) Sales price': sales_price,
+            '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain,
+            'Brokerage': 'Robinhood', 'Acquired': row['Acquired'], 'Sold': row['Sold']})
+        rows.append(new_item)
     print(f'Computed Robinhood gain/loss: {total_gain_loss}.')
+    return pd.DataFrame(rows, columns=gain_loss_columns + holding_period_columns)
 
 
-def read_and_compute_schwab_gain_loss(filename):
+def read_and_compute_robinhood_gain_loss_2024(filename):
     global gain_loss
+    gain_loss = append_rows(gain_loss, robinhood_gain_loss_2024_rows(filename))
+
+
+def parse_schwab_gain_loss(filename):
+    # The 1099-B rows of a Schwab composite 1099, in the order of the file
     with open(filename, 'r') as fn:
         # Ignore the 1099-DIV, 1099-INT, ... parts
-        while not fn.readline().strip().startswith("Form 1099 B"):
-            pass
+        line = fn.readline()
+        while not line.strip().startswith("Form 1099 B"):
+            if line == '':
+                raise ValueError(f'No "Form 1099 B" part in {filename}')
+            line = fn.readline()
         fn.readline()  # Ignore the line with numbers
         schwab_gain_loss = pd.read_csv(fn, header='infer')
+    return pd.DataFrame({
+        'Description': schwab_gain_loss['Description of property (Example 100 sh. XYZ Co.)'].map(str).to_numpy(),
+        'Date acquired': schwab_gain_loss['Date acquired'].to_numpy(),
+        'Date sold or disposed': schwab_gain_loss['Date sold or disposed'].to_numpy(),
+        'Acquired': date_ordinals(schwab_gain_loss['Date acquired']),
+        'Sold': date_ordinals(schwab_gain_loss['Date sold or disposed']),
+        'Proceeds': schwab_gain_loss['Proceeds'].astype(float).to_numpy(),
+        'Cost or other basis': schwab_gain_loss['Cost or other basis'].astype(float).to_numpy(),
+        # $x.xx
+        'Accrued market discount': schwab_gain_loss['Accrued market discount'].str[1:].astype(float).to_numpy(),
+        'Wash sale loss disallowed': schwab_gain_loss['Wash sale loss disallowed'].str[1:].astype(float).to_numpy(),
+        'Basis reported': (schwab_gain_loss['Check if basis reported to IRS'] != "No").to_numpy()})
+
+
+def schwab_gain_loss_rows(filename):
+    # Returns the rows of gain_loss for the file
+    rows = []
+    schwab_gain_loss = cached_parse(parse_schwab_gain_loss, filename)
     total_gain_loss = 0
     for index, row in schwab_gain_loss.iterrows():
         cost_basis_reported_string = ""
-        if row["Check if basis reported to IRS"] == "No":
+        if not row["Basis reported"]:
             cost_basis_reported_string = " (cost basis not reported to IRS)"
-            print(f'Warning: cost basis may be missing: {str(row["Description of property (Example 100 sh. XYZ Co.)"])}, '
+            print(f'Warning: cost basis may be missing: {row["Description"]}, '
                   f"acquired {row['Date acquired']}, sold {row['Date sold or disposed']}, proceeds {row['Proceeds']}, cost basis {row['Cost or other basis']}")
-        if float(row["Wash sale loss disallowed"][1:]) != 0.0:
-            gain = float(row["Wash sale loss disallowed"][1:])
+        if row["Wash sale loss disallowed"] != 0.0:
+            gain = row["Wash sale loss disallowed"]
             total_gain_loss += gain
             new_item = pd.Series({
                 '(a) Kind of property and description':
-                    f'Wash sale disallowed loss (determined by Schwab) of {str(row["Description of property (Example 100 sh. XYZ Co.)"])}{cost_basis_reported_string}',
+                    f'Wash sale disallowed loss (determined by Schwab) of {row["Description"]}{cost_basis_reported_string}',
                 '(b) Date acquired': row['Date acquired'],
                 '(c) Date sold': row['Date sold or disposed'], '(d) Sales price': 0,
-                '(e) Cost or other basis': -gain, '(f) LOSS': 0, '(g) GAIN': gain})
+                '(e) Cost or other basis': -gain, '(f) LOSS': 0, '(g) GAIN': gain,
+                'Brokerage': 'Schwab', 'Acquired': row['Acquired'], 'Sold': row['Sold']})
             print(f'Wash sale of {gain}.')
-            gain_loss = append_row(gain_loss, new_item)
-        sales_price = float(row['Proceeds'])
-        cost = float(row['Cost or other basis']) + float(row['Accrued market discount'][1:])
+            rows.append(new_item)
+        sales_price = row['Proceeds']
+        cost = row['Cost or other basis'] + row['Accrued market discount']
         loss = max(0.0, cost - sales_price)
         gain = max(0.0, sales_price - cost)
         total_gain_loss += gain - loss
         new_item = pd.Series({
-            '(a) Kind of property and description': f'{str(row["Description of property (Example 100 sh. XYZ Co.)"])} (Schwab){cost_basis_reported_string}',
+            '(a) Kind of property and description': f'{row["Description"]} (Schwab){cost_basis_reported_string}',
             '(b) Date acquired': row['Date acquired'],
             '(c) Date sold': row['Date sold or disposed'], '(d) Sales price': sales_price,
-            '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain})
-        gain_loss = append_row(gain_loss, new_item)
+            '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain,
+            'Brokerage': 'Schwab', 'Acquired': row['Acquired'], 'Sold': row['Sold']})
+        rows.append(new_item)
     print(f'Computed Schwab gain/loss: {total_gain_loss}.')
+    return pd.DataFrame(rows, columns=gain_loss_columns + holding_period_columns)
 
 
-def read_total_only(brokerage_name, filename):
-    # Assume no wash sales.
+def read_and_compute_schwab_gain_loss(filename):
     global gain_loss
+    gain_loss = append_rows(gain_loss, schwab_gain_loss_rows(filename))
+
+
+def total_only_gain_loss_rows(brokerage_name, filename):
+    # Assume no wash sales.
+    # Returns the rows of gain_loss for the file
+    rows = []
     proceeds = None
     cost = None
     with open(filename, 'r') as fn:
@@ -422,13 +1333,44 @@ def read_total_only(brokerage_name, filename):
         '(a) Kind of property and description': f'Various ({brokerage_name} (Total Reportable))',
         '(b) Date acquired': 'Various',
         '(c) Date sold': 'Various', '(d) Sales price': proceeds,
-        '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain})
-    gain_loss = append_row(gain_loss, new_item)
+        '(e) Cost or other basis': cost, '(f) LOSS': loss, '(g) GAIN': gain,
+        'Brokerage': brokerage_name, 'Acquired': 0, 'Sold': 0})
+    rows.append(new_item)
     print(f'Read {brokerage_name} gain/loss: {gain - loss}.')
+    return pd.DataFrame(rows, columns=gain_loss_columns + holding_period_columns)
+
+
+def read_total_only(brokerage_name, filename):
+    global gain_loss
+    gain_loss = append_rows(gain_loss, total_only_gain_loss_rows(brokerage_name, filename))
+
+
+def show_holding_period_subtotals(df=None):
+    df = gain_loss if df is None else df
+    terms = holding_periods(df)
+    subtotals = (df['(g) GAIN'] - df['(f) LOSS']).astype(float).groupby([df['Brokerage'], terms], sort=False).sum()
+    for (brokerage, term), subtotal in subtotals.items():
+        print(f'{term} gain/loss for {brokerage}: {subtotal}.')
+
+
+def line16_output(df, holding_period=False):
+    # holding_period: add a short/long-term column (not needed by 1040-NR Schedule NEC)
+    output = df[gain_loss_columns]
+    if holding_period:
+        output = output.assign(**{'(h) Term': holding_periods(df)})
+    return output
+
+
+def generate_1040NR_NEC_line16_by_year(rows_by_year, filename='{}_1040NR_NEC_line16.csv', holding_period=False):
+    # rows_by_year: {tax year: rows of gain_loss}, e.g., from crypto_pool_gain_loss_rows_by_year()
+    for tax_year, rows in rows_by_year.items():
+        line16_output(rows, holding_period).to_csv(filename.format(tax_year), index=False)
 
 
-def generate_1040NR_NEC_line16(filename='1040NR_NEC_line16.csv'):
-    gain_loss.to_csv(filename, index=False)
+def generate_1040NR_NEC_line16(filename='1040NR_NEC_line16.csv', holding_period=False):
+    if holding_period:
+        show_holding_period_subtotals()
+    line16_output(gain_loss, holding_period).to_csv(filename, index=False)
     print('1040-NR Schedule NEC line 16 generated. '
           'Disclaimer: This is for informational purposes only, '
           'and the result can be wrong. '
@@ -441,10 +1383,12 @@ if __name__ == '__main__':
     # read_and_compute_cash_app_btc('2023_cash_app_report_btc.csv', tax_year=2023)
     read_and_compute_robinhood_crypto(['examples/2023_Robinhood_crypto_activity.csv',
                                        #  '2022_Robinhood_crypto_activity.csv'
-                                       ], 2023, {1: [2021, 2022]},
+                                       ], 2023,
                                       transfers='examples/Robinhood_crypto_transfers.csv',
                                       tax_harvest_years=[2023])
+    # compare_robinhood_crypto_methods(['examples/2023_Robinhood_crypto_activity.csv'],
+    #                                  transfers='examples/Robinhood_crypto_transfers.csv')
     # read_and_compute_robinhood_gain_loss('2023_Robinhood_gain_loss.csv')
     # read_and_compute_schwab_gain_loss('2023_Schwab_1099B.CSV')
-    read_morgan_stanley_total('examples/2023_Morgan_Stanley_total.csv')
+    read_total_only('Morgan Stanley', 'examples/2023_Morgan_Stanley_total.csv')
     generate_1040NR_NEC_line16()
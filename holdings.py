@@ -0,0 +1,54 @@
+import argparse
+import datetime
+
+import dateutil.parser
+
+import generate_1040NR_NEC_line16 as line16
+
+# Crypto holdings and average cost at year-ends, quarter-ends or any dates, from one replay of the consolidated pool:
+#   python holdings.py --robinhood 2023_Robinhood_crypto_activity.csv --transfers Robinhood_crypto_transfers.csv \
+#       --year-end 2023 --quarter-ends 2024 --date 2024-05-14
+
+
+def quarter_ends(year):
+    return [datetime.date(year, 3, 31), datetime.date(year, 6, 30), datetime.date(year, 9, 30),
+            datetime.date(year, 12, 31)]
+
+
+def report_dates(year_ends=(), quarter_end_years=(), dates=()):
+    result = [datetime.date(year, 12, 31) for year in year_ends]
+    for year in quarter_end_years:
+        result += quarter_ends(year)
+    result += [dateutil.parser.parse(date).date() for date in dates]
+    return sorted(set(result))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report crypto holdings at the end of the given dates.')
+    parser.add_argument('--robinhood', nargs='*', default=[], help='Robinhood crypto activity files')
+    parser.add_argument('--cash-app', nargs='*', default=[], help='Cash App reports')
+    parser.add_argument('--transfers', help='transfers file (with an optional Platform column)')
+    parser.add_argument('--method', default='FIFO', choices=list(line16.cost_basis_methods.keys()))
+    parser.add_argument('--designations', help='lots designated for sales and outbound transfers')
+    parser.add_argument('--year-end', nargs='*', type=int, default=[], help='report at the end of these years')
+    parser.add_argument('--quarter-ends', nargs='*', type=int, default=[],
+                        help='report at the end of each quarter of these years')
+    parser.add_argument('--date', nargs='*', default=[], help='report at the end of these dates')
+    parser.add_argument('--output', help='also save the report to this .csv file')
+    parser.add_argument('--lots', action='store_true', help='also list the open lots with their IDs at the end of the last year')
+    parser.add_argument('--cache-dir', help='keep the parsed activity in this directory for later runs')
+    args = parser.parse_args()
+    line16.PARSE_CACHE_DIR = args.cache_dir
+    dates = report_dates(args.year_end, args.quarter_ends, args.date)
+    if len(dates) == 0:
+        parser.error('no dates to report, see --year-end, --quarter-ends and --date')
+    asset = line16.crypto_pool_replay(args.robinhood, args.cash_app, args.transfers, dates[-1].year, (), args.method,
+                                      journal=True, designations=args.designations)[0]
+    holdings = line16.crypto_holdings(asset, dates)
+    print(holdings.to_string(index=False))
+    if args.output is not None:
+        holdings.to_csv(args.output, index=False)
+    if args.lots:
+        # The replay went to the end of the last year
+        print(f'Open lots at the end of {dates[-1].year}:')
+        print(line16.open_lots(asset).to_string(index=False))
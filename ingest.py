@@ -0,0 +1,207 @@
+import argparse
+import contextlib
+import csv
+import io
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import generate_1040NR_NEC_line1 as line1
+import generate_1040NR_NEC_line16 as line16
+
+# Point at a client folder, detect the format of every file from its first few KB,
+# and run the matching readers concurrently:
+#   python ingest.py <folder> <tax_year> [--holding-period] [--no-cache]
+
+SNIFF_BYTES = 4096
+MONEY_RE = re.compile(r'^\(?\$?-?[\d,]+(\.\d*)?\)?$')
+CUSIP_RE = re.compile(r'^[0-9A-Z]{9}$')
+DATE_RE = re.compile(r'^\d{1,2}/\d{1,2}/\d{2,4}$')
+PARSE_CACHE_NAME = '.parse_cache'  # in the client folder, see line16.cached_parse()
+
+
+class ThreadOutput:
+    # Stands for sys.stdout while the readers run concurrently: the prints of a task go to its own buffer
+    # (see run_captured()), so that they can be shown in file order instead of interleaved
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (self.stdout if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+def run_captured(output, reader, *args):
+    # Returns the result of reader(*args) and what it printed
+    buffer = output.local.buffer = io.StringIO()
+    try:
+        return reader(*args), buffer.getvalue()
+    except Exception:
+        output.stdout.write(buffer.getvalue())
+        raise
+    finally:
+        output.local.buffer = None
+
+
+def sniff_lines(filename):
+    # Only the beginning of the file is read; the last line may be cut off
+    with open(filename, 'rb') as fn:
+        head = fn.read(SNIFF_BYTES).decode('utf-8', errors='replace')
+    return head.splitlines()
+
+
+def contains_line_starting_with(filename, prefix):
+    # Streams the file line by line instead of loading it
+    with open(filename, 'r', errors='replace') as fn:
+        return any(line.strip().startswith(prefix) for line in fn)
+
+
+def detect_csv_format(header):
+    columns = set(column.strip() for column in header)
+    if 'Time Entered' in columns:
+        return 'robinhood_crypto'
+    if {'Date', 'Symbol', 'Side', 'Cost Basis'} <= columns:
+        return 'robinhood_crypto_transfers'
+    if 'Asset Type' in columns:
+        return 'cash_app'
+    if {'Closed Date', 'ST G/L'} <= columns:
+        return 'robinhood'
+    if {'Close Date', 'Units Closed'} <= columns:
+        return 'robinhood_2024'
+    return None
+
+
+def detect_text_format(lines):
+    # Dividend details copied from the statements: the total dividend first, then one value per line
+    lines = [line.strip() for line in lines if line.strip() != '']
+    if len(lines) < 2 or not MONEY_RE.match(lines[0]):
+        return None
+    if all(MONEY_RE.match(line) for line in lines):
+        return 'total' if len(lines) == 2 else None
+    for i, line in enumerate(lines[1:10], 1):
+        if len(line.split(',')) == 3 and DATE_RE.match(lines[i + 1] if i + 1 < len(lines) else ''):
+            return 'fidelity_dividend'
+        if line == '$':
+            return 'schwab_dividend'
+        if CUSIP_RE.match(line) and i + 1 < len(lines) and DATE_RE.match(lines[i + 1]):
+            return 'morgan_stanley_dividend'
+    return None
+
+
+def detect_format(filename):
+    lines = sniff_lines(filename)
+    if len(lines) == 0:
+        return None
+    if lines[0].strip().startswith('Form 1099'):
+        # Schwab composite: the 1099-B part may come after the 1099-DIV part
+        if any(line.strip().startswith('Form 1099 B') for line in lines) or \
+                contains_line_starting_with(filename, 'Form 1099 B'):
+            return 'schwab'
+        return None
+    header = next(csv.reader([lines[0]]))
+    if len(header) > 1:
+        return detect_csv_format(header)
+    return detect_text_format(lines)
+
+
+def brokerage_name_from_filename(filename):
+    # e.g., 2023_Morgan_Stanley_total.csv -> Morgan Stanley
+    name = os.path.splitext(os.path.basename(filename))[0]
+    name = re.sub(r'^\d{4}_', '', name)
+    name = re.sub(r'_total$', '', name, flags=re.IGNORECASE)
+    return name.replace('_', ' ')
+
+
+def ingest(folder, tax_year, holding_period=False, line16_filename='1040NR_NEC_line16.csv',
+           exempt_detail_filename='exempt_detail.csv', cache=True):
+    if cache:
+        # A rerun of the folder only parses the statements that changed
+        line16.PARSE_CACHE_DIR = os.path.join(folder, PARSE_CACHE_NAME)
+    filenames = sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                       if os.path.isfile(os.path.join(folder, name)))
+    formats = {}
+    for filename in filenames:
+        formats[filename] = detect_format(filename)
+        print(f'{filename}: {formats[filename] or "not recognized, skipped"}')
+
+    crypto_files = [f for f in filenames if formats[f] == 'robinhood_crypto']
+    transfer_files = [f for f in filenames if formats[f] == 'robinhood_crypto_transfers']
+    if len(transfer_files) > 1:
+        print(f'Warning: only using the first crypto transfers file {transfer_files[0]}.')
+
+    line16_tasks = []
+    line1_tasks = []
+    for filename in filenames:
+        file_format = formats[filename]
+        if file_format == 'schwab':
+            line16_tasks.append((line16.schwab_gain_loss_rows, (filename,)))
+        elif file_format == 'robinhood':
+            line16_tasks.append((line16.robinhood_gain_loss_rows, (filename,)))
+        elif file_format == 'robinhood_2024':
+            line16_tasks.append((line16.robinhood_gain_loss_2024_rows, (filename,)))
+        elif file_format == 'cash_app':
+            line16_tasks.append((line16.cash_app_btc_gain_loss_rows, (filename, tax_year)))
+        elif file_format == 'total':
+            line16_tasks.append((line16.total_only_gain_loss_rows, (brokerage_name_from_filename(filename), filename)))
+        elif file_format == 'robinhood_crypto' and filename == crypto_files[0]:
+            # All years of crypto activity are replayed together
+            line16_tasks.append((line16.robinhood_crypto_gain_loss_rows,
+                                 (crypto_files, tax_year, transfer_files[0] if transfer_files else None)))
+        elif file_format == 'morgan_stanley_dividend':
+            line1_tasks.append((line1.morgan_stanley_exempt_detail, filename))
+        elif file_format == 'schwab_dividend':
+            line1_tasks.append((line1.schwab_exempt_detail, filename))
+        elif file_format == 'fidelity_dividend':
+            line1_tasks.append((line1.fidelity_exempt_detail, filename))
+
+    output = ThreadOutput(sys.stdout)
+    with contextlib.redirect_stdout(output), ThreadPoolExecutor() as executor:
+        # Only the funds found in the dividend details are kept from the reference tables
+        holdings = line1.scan_holdings([filename for reader, filename in line1_tasks])
+        info = executor.submit(run_captured, output, line1.load_exempt_info, tax_year, holdings) if line1_tasks else None
+        line16_futures = [executor.submit(run_captured, output, reader, *args) for reader, args in line16_tasks]
+        line1_futures = []
+        if info is not None:
+            info, printed = info.result()
+            print(printed, end='')
+            line1_futures = [executor.submit(run_captured, output, reader, filename, info)
+                             for reader, filename in line1_tasks]
+        # Keep the results and the summaries in file order regardless of which reader finishes first
+        gain_loss = line16.gain_loss.iloc[:0]
+        for future in line16_futures:
+            rows, printed = future.result()
+            print(printed, end='')
+            gain_loss = line16.append_rows(gain_loss, rows)
+        exempt_detail = line1.exempt_detail.iloc[:0]
+        for future in line1_futures:
+            rows, printed = future.result()
+            print(printed, end='')
+            exempt_detail = line1.append_rows(exempt_detail, rows)
+
+    if line16_tasks:
+        if holding_period:
+            line16.show_holding_period_subtotals(gain_loss)
+        line16.line16_output(gain_loss, holding_period).to_csv(line16_filename, index=False)
+        print(f'Wrote {line16_filename}.')
+    if line1_tasks:
+        exempt_detail.to_csv(exempt_detail_filename, index=False)
+        print(f'Wrote {exempt_detail_filename}.')
+    return gain_loss, exempt_detail
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Detect and process every statement in a client folder.')
+    parser.add_argument('folder')
+    parser.add_argument('tax_year', type=int)
+    parser.add_argument('--holding-period', action='store_true', help='add a short/long-term column to line 16')
+    parser.add_argument('--no-cache', action='store_true', help='parse every file again instead of using '
+                                                                  f'the parsed inputs kept in {PARSE_CACHE_NAME}')
+    args = parser.parse_args()
+    ingest(args.folder, args.tax_year, args.holding_period, cache=not args.no_cache)
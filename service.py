@@ -0,0 +1,179 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import generate_1040NR_NEC_line1 as line1
+import generate_1040NR_NEC_line16 as line16
+
+# A localhost service that keeps pandas and the reference tables loaded between requests.
+# POST the statement file as the request body:
+#   POST /line1?tax_year=2023&format=morgan_stanley|schwab|fidelity
+#   POST /line16?tax_year=2023&format=schwab|robinhood|robinhood_2024|cash_app|robinhood_crypto|total&brokerage=...
+#   GET /metrics
+# Every request works on its own DataFrame, so the module-level globals of the two scripts are never touched.
+
+line1_readers = {
+    'morgan_stanley': line1.morgan_stanley_exempt_detail,
+    'schwab': line1.schwab_exempt_detail,
+    'fidelity': line1.fidelity_exempt_detail,
+}
+
+line16_readers = {
+    'schwab': lambda filename, tax_year, brokerage: line16.schwab_gain_loss_rows(filename),
+    'robinhood': lambda filename, tax_year, brokerage: line16.robinhood_gain_loss_rows(filename),
+    'robinhood_2024': lambda filename, tax_year, brokerage: line16.robinhood_gain_loss_2024_rows(filename),
+    'cash_app': lambda filename, tax_year, brokerage: line16.cash_app_btc_gain_loss_rows(filename, tax_year),
+    'robinhood_crypto': lambda filename, tax_year, brokerage: line16.robinhood_crypto_gain_loss_rows([filename],
+                                                                                                     tax_year),
+    'total': lambda filename, tax_year, brokerage: line16.total_only_gain_loss_rows(brokerage, filename),
+}
+
+# The crypto activity is replayed up to the end of the tax year
+line16_formats_with_tax_year = {'robinhood_crypto'}
+
+exempt_info_by_year = {}  # tax year -> ExemptInfo, loaded on first use
+exempt_info_lock = threading.Lock()
+
+MAX_LATENCIES = 1000  # latencies kept per endpoint for the percentiles
+latencies = {}  # endpoint -> deque of seconds
+latencies_lock = threading.Lock()
+
+
+class BadRequest(Exception):
+    pass
+
+
+def get_exempt_info(tax_year):
+    # Loaded once per tax year; the lock keeps concurrent first requests from parsing the tables twice.
+    # A year without reference tables is not cached, so that tables added later are found.
+    with exempt_info_lock:
+        if tax_year not in exempt_info_by_year:
+            start = time.perf_counter()
+            try:
+                exempt_info_by_year[tax_year] = line1.load_exempt_info(tax_year)
+            except FileNotFoundError as e:
+                raise BadRequest(str(e))
+            print(f'Loaded exempt info for {tax_year} in {time.perf_counter() - start:.3f}s.')
+        return exempt_info_by_year[tax_year]
+
+
+def record_latency(endpoint, seconds):
+    with latencies_lock:
+        latencies.setdefault(endpoint, deque(maxlen=MAX_LATENCIES)).append(seconds)
+
+
+def latency_metrics():
+    with latencies_lock:
+        snapshot = {endpoint: sorted(values) for endpoint, values in latencies.items()}
+    metrics = {}
+    for endpoint, values in snapshot.items():
+        metrics[endpoint] = {
+            'count': len(values),
+            'mean_ms': 1000 * sum(values) / len(values),
+            'p50_ms': 1000 * values[(len(values) - 1) // 2],
+            'p95_ms': 1000 * values[int(0.95 * (len(values) - 1))],
+            'max_ms': 1000 * values[-1],
+        }
+    return metrics
+
+
+def with_uploaded_file(body, compute):
+    # The readers take file names, so the upload is kept in a temporary file while computing
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'wb') as fn:
+            fn.write(body)
+        return compute(filename)
+    finally:
+        os.remove(filename)
+
+
+def get_param(params, name, choices=None, default=None):
+    # Checked before calling a reader, so that errors of the readers are not taken for bad parameters
+    if name not in params:
+        if default is not None:
+            return default
+        raise BadRequest(f'Missing parameter: {name}')
+    if choices is not None and params[name] not in choices:
+        raise BadRequest(f'Unknown {name}: {params[name]}')
+    return params[name]
+
+
+def get_tax_year(params, required=True):
+    if not required and 'tax_year' not in params:
+        return None
+    tax_year = get_param(params, 'tax_year')
+    if not tax_year.isdigit():
+        raise BadRequest(f'Invalid tax_year: {tax_year}')
+    return int(tax_year)
+
+
+def compute_line1(params, body):
+    tax_year = get_tax_year(params)
+    reader = line1_readers[get_param(params, 'format', line1_readers)]
+    info = get_exempt_info(tax_year)
+    return with_uploaded_file(body, lambda filename: reader(filename, info)).to_csv(index=False)
+
+
+def compute_line16(params, body):
+    file_format = get_param(params, 'format', line16_readers)
+    tax_year = get_tax_year(params, required=file_format in line16_formats_with_tax_year)
+    reader = line16_readers[file_format]
+    brokerage = get_param(params, 'brokerage', default='Others')
+    df = with_uploaded_file(body, lambda filename: reader(filename, tax_year, brokerage))
+    return line16.line16_output(df, params.get('holding_period', '') == '1').to_csv(index=False)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def send_text(self, status, text, content_type='text/csv'):
+        data = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/metrics':
+            self.send_text(404, 'Not found\n', 'text/plain')
+            return
+        self.send_text(200, json.dumps(latency_metrics(), indent=2) + '\n', 'application/json')
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        compute = {'/line1': compute_line1, '/line16': compute_line16}.get(url.path)
+        if compute is None:
+            self.send_text(404, 'Not found\n', 'text/plain')
+            return
+        try:
+            result = compute(params, body)
+        except BadRequest as e:
+            self.send_text(400, f'{e}\n', 'text/plain')
+            return
+        except Exception as e:
+            self.send_text(500, f'{type(e).__name__}: {e}\n', 'text/plain')
+            return
+        finally:
+            record_latency(url.path, time.perf_counter() - start)
+        self.send_text(200, result)
+
+
+def serve(host='127.0.0.1', port=8016, tax_years=()):
+    # tax_years: reference tables to load before accepting requests
+    for tax_year in tax_years:
+        get_exempt_info(tax_year)
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'Serving on http://{host}:{port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(tax_years=[2023])